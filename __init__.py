@@ -26,15 +26,22 @@
 import os
 import re
 import sys
-import imp
 import atexit
 import string
 import platform
+import time
 import contextlib
+import threading
 import subprocess
 import glob as _glob
 import SCons.Script # pylint: disable=import-error
 from . import devtoolset
+from . import jobserver
+from . import compilercache
+from . import telemetry
+from . import schedule
+from . import headerscan
+from . import depfile
 
 # pylint: disable=bad-indentation,global-statement,bare-except,broad-except
 # pylint: disable=deprecated-lambda,unused-argument,eval-used
@@ -59,10 +66,26 @@ issued_warnings = set()
 printed_messages = set()
 all_targets = {}
 all_progress = []
+progress_index = {}
 ignore_help = False
 help_targets = {}
 help_options = {}
 ext_types = {}
+dirs_cache = {}
+lib_dir_index = {}
+lib_path_index = {}
+collect_cache = None
+collect_cache_updated = False
+path_split_cache = None
+path_dir_index = {}
+external_output_lock = threading.Lock()
+linker_probes = None
+ext_registry = None
+ext_entry_points = None
+target_outputs_cache = {}
+
+# Project types handled by DeclareTargets itself
+BuiltinTypes = set(["staticlib", "sharedlib", "dynamicmodule", "program", "testprograms", "install"])
 
 @contextlib.contextmanager
 def toggle_help(on):
@@ -183,11 +206,16 @@ def InitGlobals(output_dir=".", force=False):
   global args_cache, args_cache_path, args_no_cache
   global bld_dir, out_dir, mode_dir, arch_dir
   global mscver, gccver, no_arch, warnl, issued_warnings, printed_messages
-  global all_targets, all_progress
+  global all_targets, all_progress, progress_index
   global ignore_help, help_targets, help_options
-  global ext_types
+  global ext_types, dirs_cache, lib_dir_index, lib_path_index
+  global collect_cache, target_outputs_cache
 
   if bld_dir is None or force:
+    if collect_cache is not None:
+      # Files listing cache is stored in build directory
+      _WriteCollectCache()
+      collect_cache = None
     bld_dir = abspath("./.build")
 
   if out_dir is None or force:
@@ -224,31 +252,194 @@ def InitGlobals(output_dir=".", force=False):
     printed_messages = set()
     all_targets = {}
     all_progress = []
+    progress_index = {}
     ignore_help = False
     help_targets = {}
     help_options = {}
     ext_types = {}
+    dirs_cache = {}
+    lib_dir_index = {}
+    lib_path_index = {}
+    target_outputs_cache = {}
+
+
+class TextCacheBackend(object):
+  # Legacy excons.cache format: pretty printed python dictionary
+  #   all platform sections are evaluated at once
+  
+  def accept(self, data):
+    return data.lstrip().startswith("{")
+  
+  def encode(self, section):
+    return section
+  
+  def decode(self, data):
+    return data
+  
+  def load(self, data):
+    import ast
+    return ast.literal_eval(data)
+  
+  def dump(self, sections):
+    import pprint
+    return pprint.pformat(sections) + "\n"
+
+class BinaryCacheBackend(object):
+  # Versioned header followed by a marshaled dictionary
+  #   each platform section is marshaled separately so that only
+  #   the current platform's needs to be decoded
+  Version = 1
+  
+  def __init__(self):
+    import marshal
+    self.marshal = marshal
+    self.header = "excons.cache %d %d\n" % (self.Version, marshal.version)
+  
+  def accept(self, data):
+    return data.startswith(self.header)
+  
+  def encode(self, section):
+    return self.marshal.dumps(section)
+  
+  def decode(self, data):
+    return self.marshal.loads(data)
+  
+  def load(self, data):
+    return self.marshal.loads(data[len(self.header):])
+  
+  def dump(self, sections):
+    return self.header + self.marshal.dumps(sections)
+
+cache_backends = {"text": TextCacheBackend(),
+                  "binary": BinaryCacheBackend()}
+
+def RegisterCacheBackend(name, backend):
+  global cache_backends
+  # backend must implement accept, encode, decode, load and dump methods
+  cache_backends[name] = backend
+
+def GetCacheBackend():
+  global cache_backends
+  
+  # Not read through GetArgument on purpose: it would end up in the cache itself
+  name = SCons.Script.ARGUMENTS.get("cache-format", "binary")
+  if not name in cache_backends:
+    WarnOnce("Invalid cache format '%s'. Defaulting to 'binary'." % name)
+    name = "binary"
+  return cache_backends[name]
+
+def WriteFileAtomic(path, data):
+  import tempfile
+  
+  fd, tmppath = tempfile.mkstemp(prefix=os.path.basename(path) + ".", dir=os.path.dirname(path))
+  try:
+    with os.fdopen(fd, "wb") as f:
+      f.write(data)
+    # mkstemp creates file readable by owner only, use default permissions
+    mask = os.umask(0)
+    os.umask(mask)
+    os.chmod(tmppath, 0o666 & ~mask)
+    if sys.platform == "win32" and os.path.exists(path):
+      # rename won't overwrite existing file on windows
+      os.remove(path)
+    os.rename(tmppath, path)
+  except:
+    if os.path.exists(tmppath):
+      os.remove(tmppath)
+    raise
 
+def PersistentCachePath(name):
+  global bld_dir
+  # Persistent caches live in the build directory
+  return joinpath(bld_dir if bld_dir else abspath("./.build"), "excons.%s" % name)
+
+def ReadPersistentCache(name):
+  import marshal
+  
+  path = PersistentCachePath(name)
+  if os.path.isfile(path):
+    try:
+      with open(path, "rb") as f:
+        d = marshal.load(f)
+      if isinstance(d, dict):
+        return d
+    except Exception as e:
+      print("[excons] Invalid cache file '%s': %s" % (path, e))
+  return {}
+
+def WritePersistentCache(name, data):
+  import marshal
+  
+  path = PersistentCachePath(name)
+  try:
+    if not os.path.isdir(os.path.dirname(path)):
+      os.makedirs(os.path.dirname(path))
+    WriteFileAtomic(path, marshal.dumps(data))
+    return True
+  except Exception as e:
+    print("[excons] Failed to write cache file '%s': %s" % (path, e))
+    return False
 
 class Cache(dict):
   def __init__(self, *args, **kwargs):
     super(Cache, self).__init__(*args, **kwargs)
     super(Cache, self).__setitem__(sys.platform, {})
     self.updated = False
+    self.backend = None
+  
+  def _section(self):
+    pd = super(Cache, self).__getitem__(sys.platform)
+    if not isinstance(pd, dict):
+      # Decode on first access
+      pd = self.backend.decode(pd)
+      super(Cache, self).__setitem__(sys.platform, pd)
+    return pd
+  
+  def read(self, path):
+    global cache_backends
+    
+    with open(path, "rb") as f:
+      data = f.read()
+    
+    backend = None
+    for b in cache_backends.values():
+      if b.accept(data):
+        backend = b
+        break
+    if backend is None:
+      raise Exception("Unsupported excons.cache format: %s" % path)
+    
+    self.backend = backend
+    for k, v in backend.load(data).iteritems():
+      self.rawset(k, v)
+    
+    # Migrate to current cache format on next write
+    if backend is not GetCacheBackend():
+      self.updated = True
+  
+  def reset(self):
+    super(Cache, self).clear()
+    super(Cache, self).__setitem__(sys.platform, {})
+    self.backend = None
   
   def write(self):
     global args_cache_path, args_cache_echo
     
     if self.updated:
-      import pprint
-      
       if args_cache_path:
         if args_cache_echo:
           print("[excons] Write excons.cache: %s" % args_cache_path)
-        f = open(args_cache_path, "w")
-        pprint.pprint(self, f)
-        f.write("\n")
-        f.close()
+        backend = GetCacheBackend()
+        sections = {}
+        for k, v in self.iteritems():
+          if isinstance(v, dict):
+            sections[k] = backend.encode(v)
+          elif backend is self.backend:
+            # Section was never decoded, write it back as is
+            sections[k] = v
+          else:
+            sections[k] = backend.encode(self.backend.decode(v))
+        WriteFileAtomic(args_cache_path, backend.dump(sections))
         self.updated = False
       else:
         print("[excons] Cannot write arguments cache: Invalid path.")
@@ -256,7 +447,7 @@ class Cache(dict):
   def __setitem__(self, k, v):
     global args_cache_echo
 
-    pd = super(Cache, self).__getitem__(sys.platform)
+    pd = self._section()
     if pd.get(k, None) != v:
       if args_cache_echo:
         print("[excons] Update cache: %s = %s" % (k, v))
@@ -264,10 +455,10 @@ class Cache(dict):
       self.updated = True
   
   def __getitem__(self, k):
-    return super(Cache, self).__getitem__(sys.platform)[k]
+    return self._section()[k]
   
   def remove(self, k):
-    pd = super(Cache, self).__getitem__(sys.platform)
+    pd = self._section()
     if k in pd:
       if args_cache_echo:
         print("[excons] Delete cache: %s" % k)
@@ -284,7 +475,7 @@ class Cache(dict):
     super(Cache, self).__setitem__(k, v)
 
   def keys(self):
-    return super(Cache, self).__getitem__(sys.platform).keys()
+    return self._section().keys()
 
 
 
@@ -307,23 +498,14 @@ def GetArgument(key, default=None, convert=None):
         
         if os.path.exists(args_cache_path):
           print("[excons] Read excons.cache: %s" % args_cache_path)
-          import ast
-          import copy
-          
-          f = open(args_cache_path, "r")
-          cc = f.read()
-          f.close()
-          
           try:
-            d = ast.literal_eval(cc)
-            for k, v in d.iteritems():
-              if k == sys.platform:
-                for k2, v2 in v.iteritems():
-                  print("[excons]  %s = %s" % (k2, v2))
-              args_cache.rawset(k, copy.deepcopy(v))
+            args_cache.read(args_cache_path)
+            if args_cache_echo:
+              for k in args_cache.keys():
+                print("[excons]  %s = %s" % (k, args_cache[k]))
           except Exception as e:
             print(e)
-            args_cache.clear()
+            args_cache.reset()
       else:
         print("[excons] Cannot read '%s' from cache: Invalid cache path." % key)
     
@@ -375,29 +557,89 @@ def RemoveCacheKey(key):
     if args_cache:
       args_cache.remove(key)
 
+# Regular expression special characters (but '.') that prevent exact name lookup
+WhichRegexChars = re.compile(r"[\\^$*+?{}\[\]|()]")
+
+def _PathSplit():
+  global path_split_cache
+  
+  # Split PATH once per value
+  value = os.environ.get("PATH", "")
+  if path_split_cache is None or path_split_cache[0] != value:
+    pathsplit = (";" if sys.platform == "win32" else ":")
+    paths = filter(lambda x: len(x) > 0, map(lambda x: x.strip(), value.split(pathsplit)))
+    path_split_cache = (value, paths)
+  
+  return path_split_cache[1]
+
+def _PathDirEntries(path):
+  global path_dir_index
+  
+  # Returns (non-directory entry names in listing order, name lookup dictionary)
+  #   lookup keys are lower case on windows
+  mtime = _DirectoryMTime(path)
+  
+  cached = path_dir_index.get(path, None)
+  if cached is not None and cached[0] == mtime:
+    return cached[1]
+  
+  names = []
+  if mtime is not None:
+    scandir = getattr(os, "scandir", None)
+    try:
+      if scandir is not None:
+        names = [e.name for e in scandir(path) if not e.is_dir()]
+      else:
+        names = filter(lambda x: not os.path.isdir(path + "/" + x), os.listdir(path))
+    except:
+      pass
+    # Like glob, ignore hidden entries
+    names = filter(lambda x: not x.startswith("."), names)
+  
+  if sys.platform == "win32":
+    lookup = dict([(x.lower(), x) for x in names])
+  else:
+    lookup = dict([(x, x) for x in names])
+  
+  path_dir_index[path] = (mtime, (names, lookup))
+  
+  return (names, lookup)
+
 def Which(target):
-  pathsplit = None
   texp = None
+  exact = None
   
   if sys.platform == "win32":
-    pathsplit = ";"
     if re.search(r"\.(exe|bat)$", target, re.IGNORECASE) is None:
-      texp = re.compile(r"%s\.(exe|bat)" % target, re.IGNORECASE)
+      texp = (r"%s\.(exe|bat)" % target, re.IGNORECASE)
+      exact = [target.lower() + ".exe", target.lower() + ".bat"]
     else:
-      texp = re.compile(target, re.IGNORECASE)
+      texp = (target, re.IGNORECASE)
+      exact = [target.lower()]
   else:
-    pathsplit = ":"
-    texp = re.compile(target)
+    texp = (target, 0)
+    exact = [target]
+  
+  if WhichRegexChars.search(target) is not None:
+    exact = None
   
   if "PATH" in os.environ:
-    paths = filter(lambda x: len(x) > 0, map(lambda x: x.strip(), os.environ["PATH"].split(pathsplit)))
+    paths = _PathSplit()
+    
+    # Exact name lookup first
+    if exact:
+      for path in paths:
+        _, lookup = _PathDirEntries(path)
+        for name in exact:
+          if name in lookup:
+            return joinpath(path, lookup[name])
+    
+    texp = re.compile(*texp)
     for path in paths:
-      for item in glob(joinpath(path, "*")):
-        if os.path.isdir(item):
-          continue
-        bn = os.path.basename(item)
+      names, _ = _PathDirEntries(path)
+      for bn in names:
         if texp.match(bn) is not None:
-          return item.replace("\\", "/")
+          return joinpath(path, bn)
   
   return None
 
@@ -405,21 +647,26 @@ def NoConsole(env):
   if str(SCons.Script.Platform()) == "win32":
     env.Append(LINKFLAGS=" /subsystem:windows /entry:mainCRTStartup")
 
-def ParseStackSize(s):
+def ParseByteSize(s):
   if not s:
     return None
-  m = re.match(r"(\d+)([mk])?", s)
+  m = re.match(r"(\d+)([mkg])?", s)
   if m:
     sz = int(m.group(1))
     if m.group(2):
       if m.group(2) == "k":
         sz *= 1024
-      else:
+      elif m.group(2) == "m":
         sz *= 1024 * 1024
+      else:
+        sz *= 1024 * 1024 * 1024
     return sz
   else:
     return None
 
+def ParseStackSize(s):
+  return ParseByteSize(s)
+
 def SetStackSize(env, size):
   if size:
     if sys.platform == "win32":
@@ -429,6 +676,222 @@ def SetStackSize(env, size):
     else:
       env.Append(LINKFLAGS=" -Wl,--stack,0x%x" % size)
 
+def _WriteFileIfChanged(path, data):
+  # Keep file untouched (and its dependents up to date) when content is the same
+  if os.path.isfile(path):
+    with open(path, "rb") as f:
+      if f.read() == data:
+        return
+  else:
+    d = os.path.dirname(path)
+    if not os.path.isdir(d):
+      os.makedirs(d)
+  WriteFileAtomic(path, data)
+
+def SetupPrecompiledHeader(env, settings, odir, shared):
+  # Returns nodes objects should depend on and additional objects to link
+  #   env is modified for objects to use the precompiled header
+  hdr = settings.get("pch", None)
+  if not hdr:
+    return ([], [])
+
+  hdr = abspath(str(hdr))
+  if not os.path.isfile(hdr):
+    WarnOnce("Invalid precompiled header for project '%s': %s" % (settings["name"], hdr))
+    return ([], [])
+
+  # Sources don't have to include the header first, it is forced using a stub header
+  #   that also lets the compiler fallback to the original header
+  stub = joinpath(odir, "pch", os.path.basename(hdr))
+  _WriteFileIfChanged(stub, "#include \"%s\"\n" % hdr)
+
+  if str(SCons.Script.Platform()) == "win32":
+    src = stub + ".cpp"
+    _WriteFileIfChanged(src, "#include \"%s\"\n" % stub)
+    env["PCHSTOP"] = stub
+    env.Append(CCFLAGS=["/FI%s" % stub])
+    pch = env.PCH(stub + ".pch", src)
+    env["PCH"] = pch[0]
+    return ([pch[0]], [pch[1]])
+
+  else:
+    srcs = settings.get("srcs", [])
+    if isinstance(srcs, dict):
+      srcs = reduce(lambda x, y: x + list(y), srcs.values(), [])
+    if filter(lambda x: os.path.splitext(str(x))[1].lower() != ".c", srcs):
+      flagsvar = "CXXFLAGS"
+      if shared:
+        com = "$SHCXX -x c++-header -o $TARGET -c $SHCXXFLAGS $SHCCFLAGS $_CCCOMCOM $SOURCE"
+      else:
+        com = "$CXX -x c++-header -o $TARGET -c $CXXFLAGS $CCFLAGS $_CCCOMCOM $SOURCE"
+    else:
+      flagsvar = "CFLAGS"
+      if shared:
+        com = "$SHCC -x c-header -o $TARGET -c $SHCFLAGS $SHCCFLAGS $_CCCOMCOM $SOURCE"
+      else:
+        com = "$CC -x c-header -o $TARGET -c $CFLAGS $CCFLAGS $_CCCOMCOM $SOURCE"
+    # Build with environment as it is before forcing the include
+    pchenv = env.Clone()
+    if GetArgument("show-cmds", 0, int):
+      action = SCons.Script.Action(com)
+    else:
+      action = SCons.Script.Action(com, "$PROGRESS Precompiling $SOURCE ...")
+    pch = pchenv.Command(stub + ".gch", stub, action)
+    env.Append(**{flagsvar: ["-Winvalid-pch", "-include", stub]})
+    return (pch, [])
+
+def ProjectArgument(settings, flag, fmt):
+  # Get the most specific command line flag value for a project, that is
+  #   fmt % <targetname>, fmt % <targetalias>, fmt % <targettype> or flag
+  #   (i.e. 'force-%s-symvis' and 'force-symvis')
+  prj = settings["name"]
+  alias = settings.get("alias", prj)
+  flags = [fmt % prj]
+  if alias != prj:
+    flags.append(fmt % alias)
+  flags.extend([fmt % settings["type"], flag])
+  for f in flags:
+    val = SCons.Script.ARGUMENTS.get(f, None)
+    if val is not None:
+      return val
+  return None
+
+def UnityBuildSize(settings):
+  # Allow overriding of the unity build batch size from command line
+  #   using 'unity-build-<targetname|targetalias|targettype>=<int>' or
+  #         'unity-build=<int>' flag
+  if settings["type"] == "testprograms":
+    # One program per source
+    return 0
+  size = ProjectArgument(settings, "unity-build", "unity-build-%s")
+  if size is None:
+    # Check project settings
+    size = settings.get("unity-build", 0)
+  try:
+    return int(size)
+  except:
+    WarnOnce("Invalid unity build size for project '%s': %s" % (settings["name"], size))
+    return 0
+
+def _IsClang(env):
+  # Default compiler on osx is clang
+  return (sys.platform == "darwin" or "clang" in os.path.basename(env.subst("$CXX")))
+
+def _LinkerName(env):
+  # Linker selected with 'linker' flag (or custom LINKFLAGS), None for compiler default
+  m = re.search(r"-fuse-ld=(\S+)", env.subst("$LINKFLAGS"))
+  return (m.group(1) if m else None)
+
+def _LinkerSupportsICF(env):
+  return (_LinkerName(env) in ("gold", "lld", "mold"))
+
+def ProbeLinker(env, linker):
+  # Check that compiler driver can link using '-fuse-ld=<linker>'
+  #   results are persisted per compiler
+  global linker_probes
+  import shutil
+  import tempfile
+  
+  cc = env.WhereIs(env.subst("$CC"))
+  if not cc:
+    return False
+  try:
+    mtime = os.stat(cc).st_mtime
+  except:
+    return False
+  key = "%s:%s:%s" % (cc, mtime, linker)
+  
+  if linker_probes is None:
+    linker_probes = ReadPersistentCache("linker")
+  
+  rv = linker_probes.get(key, None)
+  if rv is None:
+    tmpdir = tempfile.mkdtemp()
+    try:
+      with open(tmpdir + "/probe.c", "w") as f:
+        f.write("int main() { return 0; }\n")
+      penv = dict(map(lambda x: (x[0], str(x[1])), env["ENV"].iteritems()))
+      p = subprocess.Popen([cc, "-fuse-ld=%s" % linker, tmpdir + "/probe.c", "-o", tmpdir + "/probe"], env=penv, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+      p.communicate()
+      rv = (p.returncode == 0)
+    except:
+      rv = False
+    finally:
+      shutil.rmtree(tmpdir, ignore_errors=True)
+    linker_probes[key] = rv
+    WritePersistentCache("linker", linker_probes)
+  
+  return rv
+
+def SetupLinkOptimizations(env, settings):
+  # Allow overriding from command line
+  #   using 'lto-<targetname|targetalias|targettype>=off|thin|full' or 'lto=off|thin|full' flag
+  #   and   'link-opt-<targetname|targetalias|targettype>=0|1' or 'link-opt=0|1' flag
+  lto = ProjectArgument(settings, "lto", "lto-%s")
+  if lto is None:
+    lto = settings.get("lto", "off")
+  if not lto in ("off", "thin", "full"):
+    WarnOnce("Invalid LTO mode for project '%s': %s. Should be one of: off, thin, full." % (settings["name"], lto))
+    lto = "off"
+
+  linkopt = ProjectArgument(settings, "link-opt", "link-opt-%s")
+  if linkopt is None:
+    linkopt = settings.get("link-opt", 0)
+  try:
+    linkopt = (int(linkopt) != 0)
+  except:
+    WarnOnce("Invalid link optimizations value for project '%s': %s" % (settings["name"], linkopt))
+    linkopt = False
+
+  njobs = SCons.Script.GetOption("num_jobs")
+
+  if str(SCons.Script.Platform()) == "win32":
+    if lto != "off":
+      env.Append(CCFLAGS=" /GL")
+      # Incremental code generation is available from Visual Studio 2015
+      if lto == "thin" and float(mscver) >= 14.0:
+        env.Append(LINKFLAGS=" /LTCG:incremental")
+      else:
+        env.Append(LINKFLAGS=" /LTCG")
+      env.Append(ARFLAGS=" /LTCG")
+    if linkopt:
+      env.Append(CCFLAGS=" /Gy /Gw")
+      env.Append(LINKFLAGS=" /opt:ref /opt:icf")
+
+  else:
+    if lto != "off":
+      if _IsClang(env):
+        flag = ("-flto=thin" if lto == "thin" else "-flto")
+        env.Append(CCFLAGS=[flag])
+        env.Append(LINKFLAGS=[flag])
+      else:
+        # No ThinLTO in gcc, its LTO is always partitioned
+        env.Append(CCFLAGS=["-flto"])
+        # Use as many LTO jobs as scons does
+        env.Append(LINKFLAGS=[("-flto=%d" % njobs) if njobs > 1 else "-flto"])
+        if settings["type"] == "staticlib":
+          # Keep archive usable without LTO plugin aware ar
+          env.Append(CCFLAGS=["-ffat-lto-objects"])
+    if linkopt:
+      env.Append(CCFLAGS=["-ffunction-sections", "-fdata-sections"])
+      if sys.platform == "darwin":
+        env.Append(LINKFLAGS=["-Wl,-dead_strip"])
+      else:
+        env.Append(LINKFLAGS=["-Wl,--gc-sections"])
+        # Identical code folding is not available in bfd linker
+        if _LinkerSupportsICF(env):
+          env.Append(LINKFLAGS=["-Wl,--icf=all"])
+
+def UnitySourceLanguage(src):
+  # Returns extension for the amalgamated source or None if source cannot be merged
+  ext = os.path.splitext(str(src))[1]
+  if ext == ".c":
+    return ".c"
+  elif ext.lower() in (".cpp", ".cc", ".cxx", ".c++", ".cp") or ext == ".C":
+    return ".cpp"
+  else:
+    return None
+
 def SetRPath(env, settings, relpath=None, rpaths=None):
   if rpaths is None:
     rpaths = [""]
@@ -535,7 +998,48 @@ def IsBuildOutput(path):
     p1 = p1.replace("\\", "/").lower()
   return p1.startswith(p1)
 
+def _GetDirsState(name, libdirarch):
+  global args_cache, args_no_cache, arch_dir
+  
+  # Everything GetDirs result depends on, but the file system
+  flags = ["with-%s" % name, "with-%s-inc" % name, "with-%s-lib" % name]
+  if libdirarch is None:
+    flags.append("libdir-arch")
+  state = [arch_dir]
+  for flag in flags:
+    state.append(SCons.Script.ARGUMENTS.get(flag, None))
+    if not args_no_cache and args_cache is not None:
+      state.append(args_cache.get(flag, None))
+  for var in ("_INCLUDE", "_LIB"):
+    state.append(os.environ.get(name.upper().replace("-", "_") + var, None))
+  return tuple(state)
+
+def ClearDirsCache():
+  global dirs_cache
+  dirs_cache = {}
+
 def GetDirs(name, incdirname="include", libdirname="lib", libdirarch=None, noexc=True, silent=False):
+  global dirs_cache
+  
+  # Resolution result is reused as long as none of the related
+  # 'with-<name>*' flags, cached values or environment variables changed
+  # (i.e. when preserve_arguments restores ARGUMENTS after excons.Call)
+  key = (name, incdirname, libdirname, libdirarch, noexc)
+  cached = dirs_cache.get(key, None)
+  if cached is not None and cached[0] == _GetDirsState(name, libdirarch):
+    return cached[1]
+  
+  rv = _GetDirs(name, incdirname=incdirname, libdirname=libdirname, libdirarch=libdirarch, noexc=noexc, silent=silent)
+  
+  # External headers don't need to be rescanned (header-cache)
+  headerscan.AddImmutableDir(rv[0])
+  
+  # GetDirs updates ARGUMENTS, get state after the fact
+  dirs_cache[key] = (_GetDirsState(name, libdirarch), rv)
+  
+  return rv
+
+def _GetDirs(name, incdirname="include", libdirname="lib", libdirarch=None, noexc=True, silent=False):
   global arch_dir
   
   prefixflag = "with-%s" % name
@@ -690,20 +1194,75 @@ def SharedLibraryLinkExt():
   else:
     return ".so"
 
-def LibraryFullpath(env, lib, static=False):
-  paths = env["LIBPATH"][:]
-
-  basename = lib
+# Versioned shared libraries: libxxx.so.1.2.3 (linux) or libxxx.1.2.3.dylib (osx)
+VersionedLibExp = re.compile(r"^(lib.+)\.so((?:\.\d+)+)$" if sys.platform != "darwin" else r"^(lib.+?)((?:\.\d+)+)\.dylib$")
 
-  if sys.platform == "win32":
-    # Use import library for dlls
-    basename += ".lib"
+def _DirectoryMTime(path):
+  try:
+    return os.stat(path).st_mtime
+  except:
+    return None
 
-  else:
-    global arch_dir
+def _LibraryDirEntries(path, mtime=None):
+  global lib_dir_index
+  
+  if mtime is None:
+    mtime = _DirectoryMTime(path)
+  
+  cached = lib_dir_index.get(path, None)
+  if cached is not None and cached[0] == mtime:
+    return cached[1]
+  
+  entries = set()
+  if mtime is not None:
+    try:
+      entries = set(os.listdir(path))
+    except:
+      pass
+  
+  lib_dir_index[path] = (mtime, entries)
+  
+  return entries
 
-    basename = "lib%s%s" % (lib, ".a" if static else SharedLibraryLinkExt())
+def _LibraryPathIndex(paths):
+  global lib_path_index
+  
+  key = tuple(paths)
+  mtimes = tuple(map(_DirectoryMTime, paths))
+  
+  cached = lib_path_index.get(key, None)
+  if cached is not None and cached[0] == mtimes:
+    return cached[1]
+  
+  # file name -> list of (directory, actual file name) in lookup order
+  index = {}
+  for path, mtime in zip(paths, mtimes):
+    for name in _LibraryDirEntries(path, mtime=mtime):
+      index.setdefault(name, []).append((path, name))
+  
+  # Fallback to versioned shared libraries when unversioned name is missing
+  #   prefer shortest version (soname) when several are found in the same directory
+  versioned = {}
+  for name, items in index.iteritems():
+    m = VersionedLibExp.match(name)
+    if m is not None:
+      base = m.group(1) + SharedLibraryLinkExt()
+      if not base in index:
+        versioned.setdefault(base, []).extend(items)
+  for base, items in versioned.iteritems():
+    items.sort(key=lambda x: (paths.index(x[0]), len(x[1])))
+    index[base] = items
+  
+  lib_path_index[key] = (mtimes, index)
+  
+  return index
 
+def LibraryLookupPaths(env):
+  global arch_dir
+  
+  paths = map(str, env["LIBPATH"])
+  
+  if sys.platform != "win32":
     if arch_dir == "x64":
       if not "/usr/local/lib64" in paths:
         paths.append("/usr/local/lib64")
@@ -713,13 +1272,41 @@ def LibraryFullpath(env, lib, static=False):
       paths.append("/usr/local/lib")
     if not "/usr/lib" in paths:
       paths.append("/usr/lib")
+  
+  return paths
 
-  for path in paths:
-    libpath = "%s/%s" % (path, basename)
-    if os.path.isfile(libpath):
-      return libpath
+def LibraryLookup(env, lib, static=False):
+  # Returns all matching library paths in lookup order
+  #   first one is used, remaining ones are shadowed
+  if sys.platform == "win32":
+    # Use import library for dlls
+    basename = lib + ".lib"
+  else:
+    basename = "lib%s%s" % (lib, ".a" if static else SharedLibraryLinkExt())
+  
+  rv = []
+  dirs = set()
+  for path, name in _LibraryPathIndex(LibraryLookupPaths(env)).get(basename, []):
+    if not path in dirs:
+      dirs.add(path)
+      rv.append("%s/%s" % (path, name))
+  
+  return rv
 
-  return None
+def IsLibraryFile(path):
+  # Same as os.path.isfile but goes through library directory index first
+  dn, bn = os.path.split(path)
+  return (bn in _LibraryDirEntries(dn) and os.path.isfile(path))
+
+def LibraryFullpath(env, lib, static=False):
+  found = LibraryLookup(env, lib, static=static)
+  if not found:
+    return None
+  
+  if len(found) > 1:
+    PrintOnce("Library '%s' found in several directories. Using '%s', shadowing: %s" % (lib, found[0], ", ".join(found[1:])))
+  
+  return found[0]
 
 def StaticallyLink(env, lib, silent=False):
   if os.path.isabs(lib):
@@ -745,7 +1332,8 @@ def Link(env, lib, static=False, force=True, silent=False):
     if force:
       env.Append(LIBS=[lib])
   else:
-    if static:
+    if static or VersionedLibExp.match(os.path.basename(fullpath)) is not None:
+      # Versioned shared library can't be linked using -l
       env.Append(LIBS=[env.File(fullpath)])
     else:
       dn, bn = os.path.split(fullpath)
@@ -756,38 +1344,131 @@ def Link(env, lib, static=False, force=True, silent=False):
         env.Append(LIBPATH=[dn])
       env.Append(LIBS=[ln])
 
-def CollectFiles(directory, patterns, recursive=True, exclude=None  ):
-  global VCD
+def _ReadCollectCache():
+  global collect_cache, collect_cache_updated
+  
+  if collect_cache is None:
+    collect_cache = ReadPersistentCache("collect")
+    collect_cache_updated = False
+  
+  return collect_cache
 
-  if exclude is None:
-    exclude = []
+def _WriteCollectCache():
+  global collect_cache, collect_cache_updated
+  
+  if collect_cache and collect_cache_updated:
+    if WritePersistentCache("collect", collect_cache):
+      collect_cache_updated = False
 
-  allfiles = None
+def _ListDirectory(directory, usecache=False):
+  global collect_cache_updated
+  
+  # Returns (all entry names, set of sub-directory names)
+  if usecache:
+    cache = _ReadCollectCache()
+    key = abspath(directory)
+    mtime = _DirectoryMTime(key)
+    cached = cache.get(key, None)
+    if cached is not None and cached[0] == mtime:
+      return (cached[1], cached[2])
+  
+  names = []
+  subdirs = set()
+  scandir = getattr(os, "scandir", None)
+  try:
+    if scandir is not None:
+      for entry in scandir(directory):
+        names.append(entry.name)
+        if entry.is_dir():
+          subdirs.add(entry.name)
+    else:
+      names = os.listdir(directory)
+      subdirs = set(filter(lambda x: os.path.isdir(directory + "/" + x), names))
+  except:
+    pass
+  
+  if usecache:
+    cache[key] = (mtime, names, subdirs)
+    collect_cache_updated = True
+  
+  return (names, subdirs)
+
+def _CompileCollectPatterns(patterns):
+  # Returns list of (kind, pattern, match hidden entries) tuples
+  #   kind is one of 'name', 'path' or 'glob'
+  #   - 'name' patterns are matched against the entry name
+  #   - 'path' patterns against the '<directory>/<name>' path
+  #   - 'glob' patterns spanning several directory levels are globbed
+  import fnmatch
+  
+  flags = (re.IGNORECASE if sys.platform == "win32" else 0)
+  
   rv = []
+  for pattern in patterns:
+    if type(pattern) in (str, unicode):
+      if "/" in pattern or "\\" in pattern:
+        rv.append(("glob", pattern, False))
+      else:
+        # Like glob, only match hidden entries when explicitly requested
+        rv.append(("name", re.compile(fnmatch.translate(pattern), flags), pattern.startswith(".")))
+    else:
+      rv.append(("path", pattern, False))
+  return rv
 
-  if type(directory) in (list, tuple, set):
-    for d in directory:
-      rv.extend(CollectFiles(d, patterns, recursive=recursive, exclude=exclude))
+def _CollectFiles(directory, patterns, recursive, exclude, usecache):
+  global VCD
+  
+  names, subdirs = _ListDirectory(directory, usecache=usecache)
+  
+  # Keep results grouped by pattern
+  matches = [[] for _ in patterns]
+  
+  for name in names:
+    path = (directory + "/" + name).replace("\\", "/")
+    hidden = name.startswith(".")
+    for i, (kind, pattern, inclhidden) in enumerate(patterns):
+      if kind == "name":
+        if (inclhidden or not hidden) and pattern.match(name) is not None:
+          matches[i].append(path)
+      elif kind == "path":
+        if not hidden and pattern.match(path) is not None:
+          matches[i].append(path)
+  
+  rv = []
+  for i, (kind, pattern, _) in enumerate(patterns):
+    if kind == "glob":
+      rv.extend(glob(directory + "/" + pattern))
+    else:
+      rv.extend(matches[i])
+  
+  if recursive:
+    for name in names:
+      if not name in subdirs or name.startswith(".") or name in VCD or name in exclude:
+        continue
+      rv.extend(_CollectFiles(directory + "/" + name, patterns, recursive, exclude, usecache))
+  
+  return rv
 
+def CollectFiles(directory, patterns, recursive=True, exclude=None, usecache=None):
+  if exclude is None:
+    exclude = []
+  
+  if usecache is None:
+    usecache = (GetArgument("collect-cache", 0, int) != 0)
+  
+  if not hasattr(patterns, "__iter__"):
+    patterns = [patterns]
+  patterns = _CompileCollectPatterns(patterns)
+  
+  if type(directory) in (list, tuple, set):
+    directories = directory
   else:
-    for pattern in patterns:
-      if type(pattern) in (str, unicode):
-        items = glob(directory + "/" + pattern)
-        for item in items:
-          rv.append(item)
-      else:
-        allfiles = glob(directory + "/*")
-        rv.extend(filter(lambda x: pattern.match(x) is not None, allfiles)) # pylint: disable=cell-var-from-loop
-
-    if recursive:
-      if allfiles is None:
-        allfiles = glob(directory + "/*")
-      for subdir in filter(os.path.isdir, allfiles):
-        dn = os.path.basename(subdir)
-        if dn in VCD or dn in exclude:
-          continue
-        rv += CollectFiles(subdir, patterns, recursive=True, exclude=exclude)
-
+    directories = [directory]
+  
+  rv = []
+  for d in directories:
+    rv.extend(_CollectFiles(d, patterns, recursive, exclude, usecache))
+  
   return rv
 
 def NormalizedRelativePath(path, baseDirectory):
@@ -843,6 +1524,13 @@ def MakeBaseEnv(noarch=None, output_dir="."):
     env.Append(CPPDEFINES=["NDEBUG"])
     env.Append(LINKFLAGS=" /debug /opt:noref /opt:noicf /incremental:yes")
   
+  def SetupGCCSplitDwarf(env):
+    # Keep debug info out of objects (.dwo files), gdb index requires gold, lld or mold
+    if str(SCons.Script.Platform()) != "darwin" and GetArgument("split-dwarf", 0, int):
+      env.Append(CCFLAGS=["-gsplit-dwarf"])
+      if _LinkerName(env) in ("gold", "lld", "mold"):
+        env.Append(LINKFLAGS=["-Wl,--gdb-index"])
+  
   def SetupGCCDebug(env):
     if arch_dir == "x64":
       if str(SCons.Script.Platform()) == "darwin":
@@ -861,6 +1549,7 @@ def MakeBaseEnv(noarch=None, output_dir="."):
     
     env.Append(CPPFLAGS=" -O0 -g -ggdb")
     env.Append(CPPDEFINES=["_DEBUG"])
+    SetupGCCSplitDwarf(env)
   
   def SetupGCCRelease(env):
     if arch_dir == "x64":
@@ -905,6 +1594,7 @@ def MakeBaseEnv(noarch=None, output_dir="."):
     
     env.Append(CPPFLAGS=" -O3 -g -ggdb")
     env.Append(CPPDEFINES=["NDEBUG"])
+    SetupGCCSplitDwarf(env)
   
   SetupRelease = None
   SetupDebug = None
@@ -998,6 +1688,15 @@ def MakeBaseEnv(noarch=None, output_dir="."):
       cppflags += " -Werror"
     env.Append(CPPFLAGS=cppflags)
     
+    linker = GetArgument("linker", "")
+    if linker:
+      if not linker in ("bfd", "gold", "lld", "mold"):
+        WarnOnce("Invalid linker \"%s\". Should be one of: bfd, gold, lld, mold. Use default linker." % linker)
+      elif not ProbeLinker(env, linker):
+        WarnOnce("Compiler cannot use \"%s\" linker. Use default linker." % linker)
+      else:
+        env.Append(LINKFLAGS=["-fuse-ld=%s" % linker])
+    
     SetupRelease = SetupGCCRelease
     SetupDebug = SetupGCCDebug
     if GetArgument("with-debug-info", 0, int):
@@ -1007,6 +1706,7 @@ def MakeBaseEnv(noarch=None, output_dir="."):
       env.Append(CCFLAGS=" -fno-common -DPIC")
       if os.path.exists("/opt/local"):
         env.Append(CPPPATH=["/opt/local/include"])
+        headerscan.AddImmutableDir("/opt/local/include")
         env.Append(LIBPATH=["/opt/local/lib"])
       
       vers = map(int, platform.mac_ver()[0].split("."))
@@ -1063,31 +1763,48 @@ def MakeBaseEnv(noarch=None, output_dir="."):
   env["TARGET_ARCH"] = arch_dir
   env["TARGET_MODE"] = mode_dir
   
+  # Measure commands CPU time and memory usage (build-report, schedule)
+  env["SPAWN"] = telemetry.MeasureSpawn(env["SPAWN"])
+  
+  cache_hits = SetupCompilerCache(env)
+  
+  # Persistent scan cache for external headers
+  scanner = headerscan.Setup(env)
+  
+  # Compiler generated header dependencies
+  depfile.Setup(env, scanner)
+  
   # Progress
   env["PROGRESS"] = ""
   
   def BuildProgress(node):
-    global all_progress
+    global progress_index
     
     e = node.env
     if e is None:
       return
     
-    n = abspath(str(node))
-    
-    for i in xrange(len(all_progress)):
-      name, nodes, cnt = all_progress[i]
-      if n in nodes:
-        cnt += 1
-        progress = "%d" % int(100 * (float(cnt) / len(nodes)))
-        e["PROGRESS"] = "[ %s / %s%% ]" % (name, progress)
-        
-        all_progress[i] = (name, nodes, cnt)
-        
-        break
+    entry = progress_index.get(abspath(str(node)), None)
+    if entry is not None:
+      # entry is [name, node count, processed count]
+      entry[2] += 1
+      progress = "%d" % int(100 * (float(entry[2]) / entry[1]))
+      if cache_hits:
+        e["PROGRESS"] = "[ %s / %s%% | %d cached ]" % (entry[0], progress, compilercache.Stats["hits"])
+      else:
+        e["PROGRESS"] = "[ %s / %s%% ]" % (entry[0], progress)
   
   SCons.Script.Progress(BuildProgress)
   
+  # Record commands (build-report, schedule)
+  env["SPAWN"] = telemetry.WrapSpawn(env["SPAWN"])
+  
+  # Order build using recorded durations
+  schedule.Setup()
+  
+  # Share job slots with nested make builds (cmake, automake)
+  env["SPAWN"] = jobserver.WrapSpawn(env["SPAWN"])
+  
   # Build output
   try:
     from colorama import init
@@ -1115,6 +1832,8 @@ def MakeBaseEnv(noarch=None, output_dir="."):
     show_cmds = (int(SCons.Script.ARGUMENTS.get("show-cmds", "0")) != 0)
   
   def PrintCmd(s, target, source, env):
+    # Called right before a command runs, identifies commands in build report
+    telemetry.SetCurrentTarget(target)
     sys.stdout.write("%s\n" % env.subst(s))
   env["PRINT_CMD_LINE_FUNC"] = PrintCmd
 
@@ -1127,22 +1846,175 @@ def MakeBaseEnv(noarch=None, output_dir="."):
       else:
         env[k] = "%s\n$%s" % (v, k[:-3])
 
-  for item in glob(os.path.dirname(__file__) + "/envext/*.py"):
-    bn = os.path.basename(item)
-    if bn == "__init__.py":
-      continue
-    try:
+  return env
+
+def _EnvironmentExtensionRegistry():
+  global ext_registry
+  # Extensions shipped with excons, discovered once
+  if ext_registry is None:
+    ext_registry = {}
+    for item in glob(os.path.dirname(__file__) + "/envext/*.py"):
       extname = os.path.splitext(os.path.basename(item))[0]
-      mod = imp.load_source(extname, item)
-      if not hasattr(mod, "SetupEnvironment"):
-        print("Missing 'SetupEnvironment' function in '%s'" % item)
+      if extname != "__init__":
+        ext_registry[extname] = ".envext.%s" % extname
+  return ext_registry
+
+def _EnvironmentExtensionEntryPoints():
+  global ext_entry_points
+  # Third party extensions declared in 'excons.envext' entry points group
+  if ext_entry_points is None:
+    ext_entry_points = {}
+    try:
+      import pkg_resources
+      for ep in pkg_resources.iter_entry_points("excons.envext"):
+        if not ep.name in ext_entry_points:
+          ext_entry_points[ep.name] = ep
+    except Exception:
+      pass
+  return ext_entry_points
+
+def RegisterEnvironmentExtension(typename, setup):
+  global ext_types
+  # 'setup' is either a SetupEnvironment function or the name of a module defining one
+  _EnvironmentExtensionRegistry()[typename] = setup
+  ext_types.pop(typename, None)
+
+def GetEnvironmentExtension(typename):
+  global ext_types
+  # Returns project type SetupEnvironment function (None if there's none)
+  #   extension modules are only imported on first use
+  import importlib
+  
+  if typename in ext_types:
+    return ext_types[typename]
+  
+  if typename in BuiltinTypes:
+    return None
+  
+  setup = _EnvironmentExtensionRegistry().get(typename, None)
+  if setup is None:
+    setup = _EnvironmentExtensionEntryPoints().get(typename, None)
+  
+  func = None
+  if setup is not None:
+    try:
+      if hasattr(setup, "load"):
+        # Entry point
+        setup = setup.load()
+      if isinstance(setup, basestring):
+        setup = importlib.import_module(setup, __name__)
+      if hasattr(setup, "SetupEnvironment"):
+        func = setup.SetupEnvironment
+      elif callable(setup):
+        func = setup
       else:
-        #mod.SetupEnvironment(env)
-        ext_types[extname] = mod.SetupEnvironment
+        print("Missing 'SetupEnvironment' function for '%s'" % typename)
     except Exception as e:
-      print("Failed to load '%s': %s" % (item, e))
+      print("Failed to load '%s': %s" % (typename, e))
+  
+  ext_types[typename] = func
+  
+  return func
 
-  return env
+def CompilerCache():
+  # Returns None, 'builtin' or compiler launcher tool
+  cc = GetArgument("compiler-cache", "")
+  if cc in ("", "0", "none"):
+    return None
+  return cc
+
+def CompilerLauncher():
+  # Compiler launcher command line as a list, None when compiler cache is disabled
+  cc = CompilerCache()
+  if cc is None:
+    return None
+  elif cc == "builtin":
+    if sys.platform == "win32":
+      WarnOnce("Builtin compiler cache is not supported with Visual Studio compiler")
+      return None
+    cachedir = os.path.abspath(os.path.expanduser(GetArgument("compiler-cache-dir", compilercache.DefaultDir)))
+    maxsize = ParseByteSize(GetArgument("compiler-cache-size", None))
+    return compilercache.LauncherArgs(cachedir, (maxsize if maxsize else compilercache.DefaultMaxSize))
+  else:
+    return cc.split()
+
+def _ShellUnescape(arg):
+  # Undo SCons posix quoting of an argument, None when shell interpretation is required
+  if len(arg) >= 2 and arg[0] == "\"" and arg[-1] == "\"":
+    arg = arg[1:-1]
+    if re.search(r"[\"\\$`]", arg):
+      return None
+  elif re.search(r"[\s\"'\\$`*?\[\]<>|&;(){}~#!]", arg):
+    return None
+  return arg
+
+def _SourceScannerBuilder(builder, scanner):
+  # Copy of builder using 'scanner' as source scanner
+  import copy
+  import SCons.Builder # pylint: disable=import-error
+  
+  if isinstance(builder, SCons.Builder.CompositeBuilder):
+    # Proxy (i.e. object builders): calls are forwarded to the wrapped builder
+    return SCons.Builder.CompositeBuilder(_SourceScannerBuilder(builder.builder, scanner), builder.cmdgen)
+  
+  builder = copy.copy(builder)
+  builder._memo = {} # pylint: disable=protected-access
+  builder.source_scanner = scanner
+  return builder
+
+def SetObjectSourceScanner(env, scanner):
+  # Object builders have their own source scanner (SCons SourceFileScanner)
+  #   rather than using env['SCANNERS']: replace them in env with copies
+  #   using 'scanner' for C/C++ sources
+  import SCons.Scanner # pylint: disable=import-error
+  
+  cexts = map(str, env.subst_list("$CPPSUFFIXES")[0])
+  
+  for name in ("StaticObject", "SharedObject"):
+    builder = env["BUILDERS"].get(name, None)
+    if builder is None:
+      continue
+    scanners = {}
+    if builder.source_scanner is not None and isinstance(builder.source_scanner.function, dict):
+      scanners.update(builder.source_scanner.function)
+    for ext in cexts:
+      scanners[ext] = scanner
+    builder = _SourceScannerBuilder(builder, SCons.Scanner.Base(scanners, name="ObjectSourceScanner"))
+    env["BUILDERS"][name] = builder
+    if name == "StaticObject":
+      env["BUILDERS"]["Object"] = builder
+
+def SetupCompilerCache(env):
+  # Returns True when cache hits can be reported (builtin cache)
+  launcher = CompilerLauncher()
+  if launcher is None:
+    return False
+
+  env["COMPILER_LAUNCHER"] = launcher
+  for k in ("CCCOM", "SHCCCOM", "CXXCOM", "SHCXXCOM"):
+    if env.get(k, None):
+      env[k] = "$COMPILER_LAUNCHER %s" % env[k]
+
+  if CompilerCache() != "builtin":
+    return False
+
+  # Run builtin cache in-process rather than through its launcher script
+  spawn = env["SPAWN"]
+  cachedir, maxsize, _ = compilercache.ParseLauncherArgs(launcher[2:])
+  n = len(launcher)
+
+  def CompilerCacheSpawn(sh, escape, cmd, args, env):
+    # Arguments are escaped for the shell, anything that can't be trivially
+    #   unescaped goes through the launcher script
+    cargs = (map(_ShellUnescape, args[n:]) if list(args[:n]) == launcher else [None])
+    if None in cargs:
+      return spawn(sh, escape, cmd, args, env)
+    penv = dict(map(lambda x: (x[0], str(x[1])), env.iteritems()))
+    return compilercache.Compile(cargs, cachedir=cachedir, maxsize=maxsize, env=penv)
+
+  env["SPAWN"] = CompilerCacheSpawn
+
+  return True
 
 def OutputBaseDirectory():
   global out_dir, mode_dir, arch_dir, no_arch
@@ -1164,6 +2036,44 @@ def BuildBaseDirectory():
       odir = joinpath(odir, "gcc-%s" % gccver)
   return odir
 
+def RunExternalCommand(cmd, logpath, env=None, tool=None, name=None):
+  # Run command with its output redirected to 'logpath'
+  #   'name' is the command name reported by build-report (defaults to 'tool')
+  #   output is then replayed as a single block so that external steps
+  #   running concurrently (scons -j) don't interleave their outputs
+  Print("Run Command: %s" % cmd, tool=tool)
+  
+  # Take a job slot so that nested make builds account for this step
+  with jobserver.Slot():
+    with open(logpath, "w") as log:
+      start = time.time()
+      p = subprocess.Popen(cmd, env=env, shell=True, stdout=log, stderr=subprocess.STDOUT)
+      cpu, rss = telemetry.Wait(p)
+      telemetry.Record(name if name else tool, start, time.time(), p.returncode, cpu=cpu, rss=rss, kind="configure")
+      telemetry.SetCurrentTarget(None)
+  
+  with external_output_lock:
+    with open(logpath, "r") as log:
+      sys.stdout.write(log.read())
+    if p.returncode != 0:
+      Print("Command failed (%d). See %s" % (p.returncode, logpath), tool=tool)
+    sys.stdout.flush()
+  
+  return p.returncode
+
+def StreamLines(stream, maxlen=65536):
+  # Yield process output lines as they come (trailing end of line included)
+  #   lines longer than 'maxlen' characters are yielded in several parts
+  for line in iter(lambda: stream.readline(maxlen), b""):
+    yield line
+
+def OpenExternalLog(logpath, tool=None):
+  # Returns opened log file when external builds output is redirected, None otherwise
+  if GetArgument("external-log", 0, int) == 0:
+    return None
+  Print("Output redirected to %s" % logpath, tool=tool)
+  return open(logpath, "w")
+
 def Call(path, targets=None, overrides=None, imp=None, keepflags=None): # pylint: disable=redefined-outer-name
   if overrides is None:
     overrides = {}
@@ -1206,6 +2116,8 @@ def Call(path, targets=None, overrides=None, imp=None, keepflags=None): # pylint
 def GetOptionsString():
   return """GENERIC OPTIONS
   no-cache=0|1                    : Ignore excons flag cache                                         [0]
+  cache-format=binary|text        : excons flag cache file format                                    [binary]
+                                    Existing cache files are converted on next write
   debug=0|1                       : Build in debug mode                                              [0]
   shared-build=0|1                : Use same output and intermediate file directories for submodules [1]
   with-debug-info=0|1             : Build with debug info                                            [0]
@@ -1219,6 +2131,28 @@ def GetOptionsString():
                                     When set to 'subdir', use '<prefix>/lib/x86' or '<prefix>/lib/x64'
                                     When set to 'suffix', use '<prefix>/lib' or '<prefix>/lib64'
   show-cmds=0|1                   : Show build commands                                              [0]
+  collect-cache=0|1               : Cache CollectFiles directory listings across invocations         [0]
+  jobserver=0|1                   : Share scons -j job slots with nested make builds                 [1]    (linux/mac)
+  external-log=0|1                : Write cmake/automake builds output to a log file                 [0]
+                                    instead of the console ('<build dir>/<name>/build.log')
+  schedule=default|critical-path  : Build order                                                      [default]
+                                    With 'critical-path', projects other projects depend on and long
+                                    compiles are started first, based on previous builds timings
+  build-report=<path>             : Write commands timing report (JSON, or CSV if path ends with .csv) []
+                                    and a chrome trace file ('<path without extension>.trace.json')
+  header-cache=0|1                : Persist include directives of external headers (with-xxx flags)  [0]
+                                    Headers are re-read when their directory or library changes
+  header-deps=scanner|depfile     : Header dependencies source                                       [scanner]
+                                    With 'depfile', use compiler generated dependencies (-MMD, /showIncludes)
+                                    from previous build instead of scanning sources
+  compiler-cache=<str>            : Compiler cache to use ('builtin' or launcher tool, i.e. 'ccache') []
+                                    Also used for cmake/automake builds
+  compiler-cache-dir=<path>       : Builtin compiler cache directory                                 [~/.excons/compiler-cache]
+  compiler-cache-size=<str>       : Builtin compiler cache maximum size                              [5g]
+                                    Letters 'k', 'm' and 'g' can be used
+  linker=bfd|gold|lld|mold        : Linker to use instead of compiler default                               (linux/mac)
+  split-dwarf=0|1                 : Write debug info to separate .dwo files                          [0]    (linux)
+                                    Also generate gdb index when linker is gold, lld or mold
   mscver=<float>                  : Visual C runtime version                                         [10.0] (windows)
   with-vcvars=<str>               : Specify Visual Studio variables setup script                            (windows)
   no-console=0|1                  : Use window subsystem                                             [0]    (windows)
@@ -1226,6 +2160,15 @@ def GetOptionsString():
   strip=0|1                       : Strip dead code                                                  [0]    (linux/mac)
   use-c++11=0|1                   : Compile code as C++ 11                                           [0]    (linux/mac)
   use-stdc++=0|1                  : Use libstdc++ for C++ 11                                         [0]    (mac)
+  lto=off|thin|full               : Link time optimization mode                                      [off]
+  lto-xxx=off|thin|full           : Link time optimization mode for 'xxx' (see force-xxx-symvis below)
+  link-opt=0|1                    : Remove unused code and data at link time                         [0]
+                                    Also fold identical code when supported by linker
+  link-opt-xxx=0|1                : Link optimizations for 'xxx' (see force-xxx-symvis below)
+  unity-build=<int>               : Compile sources in batches of the given size                     [0]
+  unity-build-xxx=<int>           : Unity build batch size for 'xxx' (see force-xxx-symvis below)
+                                    Not applied to testprograms projects
+                                    Use project 'unity-exclude' setting for sources that can't be merged
   force-symvis=default|hidden     : Force compiler default symbol visibility                                (linux/mac)
   force-xxx-symvis=defalut|hidden : Force compiler default symbol visibility for 'xxx'                      (linux/mac)
                                     where xxx can be one of the following:
@@ -1318,6 +2261,8 @@ def SyncCache():
   if not args_no_cache and args_cache:
     args_cache.write()
 
+  _WriteCollectCache()
+
 def ExternalLibHelp(name):
   return string.Template("""EXTERNAL ${uc_name} OPTIONS
   with-${name}=<path>     : ${name} root directory.
@@ -1371,14 +2316,14 @@ def ExternalLibRequire(name, libnameFunc=None, definesFunc=None, extraEnvFunc=No
         libpath = None
         if arch_dir == "x64" and not libdir.endswith("64"):
           libpath = libdir + "64/lib" + libname + libext
-          if not os.path.isfile(libpath):
+          if not IsLibraryFile(libpath):
             libpath = None
           else:
             libdir = libdir + "64"
         if libpath is None:
           libpath = libdir + "/lib" + libname + libext
 
-      valid = (os.path.isfile(libpath) or IsBuildOutput(libpath))
+      valid = (IsLibraryFile(libpath) or IsBuildOutput(libpath))
 
     if valid:
       def RequireFunc(env):
@@ -1390,6 +2335,10 @@ def ExternalLibRequire(name, libnameFunc=None, definesFunc=None, extraEnvFunc=No
         if extraEnvFunc:
           extraEnvFunc(env, staticlink)
 
+      # Library file is a better version indicator than headers directory
+      if libpath and IsLibraryFile(libpath):
+        headerscan.AddImmutableDir(incdir, versionfile=libpath)
+
       rv["require"] = RequireFunc
       rv["incdir"] = incdir
       rv["libdir"] = libdir
@@ -1405,6 +2354,7 @@ def _AddDeps(penv, settings, tgt, all_projs):
       for dep in settings[k]:
         if dep in all_projs:
           penv.Depends(tgt, all_projs[dep])
+          schedule.AddDependency(settings["name"], dep)
           # but should not clean all_projs[dep]
         elif dep in all_targets:
           penv.Depends(tgt, all_targets[dep])
@@ -1432,6 +2382,20 @@ def _InstallFile(penv, pout, dstdir, filepath, basename=None):
       insttgt = penv.InstallAs(dstdir + "/" + basename, filepath)
     pout.extend(insttgt)
 
+def _AddProgress(name, nodes):
+  global all_progress, progress_index
+  
+  if not nodes:
+    return
+  
+  entry = [name, len(nodes), 0]
+  all_progress.append(entry)
+  
+  # When a node belongs to several projects, first declared one wins
+  for n in nodes:
+    if not n in progress_index:
+      progress_index[n] = entry
+
 def DeclareTargets(env, prjs):
   global bld_dir, out_dir, mode_dir, arch_dir, mscver, gccver, no_arch, args_no_cache, args_cache, all_targets, all_progress, ext_types, help_targets
 
@@ -1455,14 +2419,17 @@ def DeclareTargets(env, prjs):
     if not "type" in settings:
       print("[excons] Project \"%s\" missing \"type\"" % prj)
       continue
-    elif settings["type"] not in ext_types and settings["type"] != "install" and not "srcs" in settings:
+
+    extsetup = GetEnvironmentExtension(settings["type"])
+    if extsetup is None and settings["type"] != "install" and not "srcs" in settings:
       print("[excons] Project \"%s\" missing \"srcs\"" % prj)
       continue
 
     penv = env.Clone()
 
-    if settings["type"] in ext_types:
-      pout = ext_types[settings["type"]](penv, settings)
+    if extsetup is not None:
+      pout = extsetup(penv, settings)
+      telemetry.AddTargets(prj, settings["type"], pout if pout else [])
       if pout:
         if not prj in help_targets:
           AddHelpTargets({prj: ("Build %s project" % settings["type"]) if not desc else desc})
@@ -1558,14 +2525,7 @@ def DeclareTargets(env, prjs):
         #         'force-<targetalias>-symvis=default|hidden' or
         #         'force-<targettype>-symvis=default|hidden' or
         #         'force-symvis=default|hidden' flag
-        flags = ["force-%s-symvis" % prj]
-        if alias != prj:
-          flags.append("force-%s-symvis" % alias)
-        flags.extend(["force-%s-symvis" % settings["type"], "force-symvis"])
-        for flag in flags:
-           symvis = SCons.Script.ARGUMENTS.get(flag, None)
-           if symvis is not None:
-              break
+        symvis = ProjectArgument(settings, "force-symvis", "force-%s-symvis")
         if symvis is None:
           # Check project settings
           symvis = settings.get("symvis", None)
@@ -1578,12 +2538,55 @@ def DeclareTargets(env, prjs):
           if settings.get("inlvis", "hidden") == "hidden":
             penv.Append(CXXFLAGS=["-fvisibility-inlines-hidden"])
       
-      objs = []
+      # Link time optimizations
+      SetupLinkOptimizations(penv, settings)
+      
+      # Precompiled header
+      pchdeps, pchobjs = SetupPrecompiledHeader(penv, settings, odir, shared)
+      objs = list(pchobjs)
+
       srcs = settings.get("srcs", [])
       # Source level dependencies
       srcdeps = settings.get("srcdeps", {})
       prereqs = srcdeps.get("*", [])
       srcdict = isinstance(srcs, dict)
+      
+      def SourceSetting(d, src):
+        key = str(src)
+        val = d.get(key, [])
+        if not val:
+          key = key.replace("\\", "/")
+          val = d.get(key, [])
+          if not val:
+            val = d.get(os.path.basename(key), [])
+        return val
+      
+      def AddObject(objbase, src, deps):
+        if shared:
+          obj = penv.SharedObject(objbase + ".os", src, **depfile.ObjectOverrides(objbase + ".os"))
+        else:
+          obj = penv.StaticObject(objbase + ".o", src, **depfile.ObjectOverrides(objbase + ".o"))
+        depfile.AddObject(penv, obj)
+        #objs.append(obj)
+        objs.extend(obj)
+        if deps:
+          #Print("Add dependencies for '%s': %s" % (str(obj[0]).replace("\\", "/"), map(lambda x: str(x).replace("\\", "/"), deps)))
+          penv.Depends(obj, deps)
+        # target prerequisites
+        if prereqs:
+          penv.Depends(obj, prereqs)
+        if pchdeps:
+          penv.Depends(obj, pchdeps)
+        if splitdwarf:
+          penv.Clean(obj, os.path.splitext(str(obj[0]))[0] + ".dwo")
+      
+      splitdwarf = ("-gsplit-dwarf" in penv.subst("$CCFLAGS"))
+      
+      # Unity build: batch sources by language
+      unitysize = UnityBuildSize(settings)
+      unityexcl = dict.fromkeys(map(lambda x: str(x).replace("\\", "/"), settings.get("unity-exclude", [])), True)
+      unitysrcs = {}
+      
       for item in srcs:
         if not srcdict:
           extradir = ""
@@ -1596,25 +2599,25 @@ def DeclareTargets(env, prjs):
           bnnoext = os.path.splitext(bn)[0]
           if extradir:
             bnnoext = extradir + "/" + bnnoext
-          if shared:
-            obj = penv.SharedObject(joinpath(odir, bnnoext + ".os"), src)
+          deps = SourceSetting(srcdeps, src)
+          ext = (UnitySourceLanguage(src) if unitysize > 1 else None)
+          if ext is not None and not SourceSetting(unityexcl, src):
+            unitysrcs.setdefault(ext, []).append((src, bnnoext, deps))
           else:
-            obj = penv.StaticObject(joinpath(odir, bnnoext + ".o"), src)
-          #objs.append(obj)
-          objs.extend(obj)
-          key = str(src)
-          deps = srcdeps.get(key, [])
-          if not deps:
-            key = key.replace("\\", "/")
-            deps = srcdeps.get(key, [])
-            if not deps:
-              deps = srcdeps.get(bn, [])
-          if deps:
-            #Print("Add dependencies for '%s': %s" % (str(obj[0]).replace("\\", "/"), map(lambda x: str(x).replace("\\", "/"), deps)))
-            penv.Depends(obj, deps)
-          # target prerequisites
-          if prereqs:
-            penv.Depends(obj, prereqs)
+            AddObject(joinpath(odir, bnnoext), src, deps)
+      
+      for ext in sorted(unitysrcs.keys()):
+        lst = unitysrcs[ext]
+        for i in xrange(0, len(lst), unitysize):
+          batch = lst[i:i+unitysize]
+          if len(batch) == 1:
+            src, bnnoext, deps = batch[0]
+            AddObject(joinpath(odir, bnnoext), src, deps)
+          else:
+            unitybase = joinpath(odir, "unity", "unity%s_%d" % (ext.replace(".", "_"), i // unitysize))
+            _WriteFileIfChanged(unitybase + ext, "".join(map(lambda x: "#include \"%s\"\n" % abspath(str(x[0])), batch)))
+            deps = reduce(lambda x, y: x + list(y[2]), batch, [])
+            AddObject(unitybase, unitybase + ext, deps)
       
       #progress_nodes = set(map(lambda x: abspath(str(x[0])), objs))
       progress_nodes = set(map(lambda x: abspath(str(x)), objs))
@@ -1881,11 +2884,15 @@ def DeclareTargets(env, prjs):
         SetRPath(penv, settings, relpath=relpath)
         
         for obj in objs:
+          if obj in pchobjs:
+            continue
+          
           name = os.path.splitext(os.path.basename(str(obj)))[0]
           
           outbn = outbindir + "/" + name
           
-          prg = penv.Program(outbn, obj)
+          # Precompiled header object (msvc) is linked in every program
+          prg = penv.Program(outbn, [obj] + pchobjs)
           
           progress_nodes.add(abspath(str(prg[0])))
           
@@ -2015,7 +3022,9 @@ def DeclareTargets(env, prjs):
       
       if settings["type"] != "install":
         # no progress for 'install' target
-        all_progress.append((prj, progress_nodes, 0))
+        _AddProgress(prj, progress_nodes)
+      
+      telemetry.AddTargets(prj, settings["type"], list(progress_nodes) + (pout if pout else []))
 
       if pout:
         tgts = all_projs.get(prj, [])
@@ -2038,25 +3047,67 @@ def DeclareTargets(env, prjs):
   
   env["EXCONS_TARGETS"] = all_projs
 
+  # New nodes may have been added to already queried targets
+  ClearTargetOutputFilesCache()
+
   SetHelp(GetHelpString())
 
   return all_projs
 
-def GetTargetOutputFiles(env, target, builders=None, verbose=False):
-  def GetTargetOuptutFilesIter(env, node):
+def ClearTargetOutputFilesCache():
+  global target_outputs_cache
+  # Call when dependency graph changes after outputs were queried
+  target_outputs_cache = {}
+
+def _TargetOutputFilesCache(env, builders):
+  global target_outputs_cache
+  # One cache per environment (builder names lookup) and builders filter
+  key = (id(env), (None if builders is None else frozenset(builders)))
+  entry = target_outputs_cache.get(key, None)
+  if entry is None:
+    # Keep a reference on env so that its id isn't reused
+    entry = (env, {})
+    target_outputs_cache[key] = entry
+  return entry[1]
+
+def _TargetOutputFiles(env, nodes, builders, verbose):
+  # Iterative depth first traversal, visiting each node once
+  rv = []
+  visited = set()
+  stack = list(reversed(nodes))
+  while stack:
+    node = stack.pop()
+    if node in visited:
+      continue
+    visited.add(node)
     if node.has_builder():
       builder_name = node.get_builder().get_name(env)
       if builders is None or builder_name in builders:
-        yield node
+        rv.append(node)
       elif verbose:
         print("Ignore builder '%s' output: %s" % (builder_name, node))
-    
-    for kid in node.all_children():
-      for ofile in GetTargetOuptutFilesIter(env, kid):
-        yield ofile
-  
+    stack.extend(reversed(node.all_children()))
+  return rv
+
+def GetTargetOutputFiles(env, target, builders=None, verbose=False):
   node = env.arg2nodes(target, env.fs.Entry)[0]
-  return list(GetTargetOuptutFilesIter(env, node))
+  cache = _TargetOutputFilesCache(env, builders)
+  rv = cache.get(node, None)
+  if rv is None:
+    rv = _TargetOutputFiles(env, [node], builders, verbose)
+    cache[node] = rv
+  return list(rv)
+
+def GetTargetsOutputFiles(env, targets, builders=None, verbose=False):
+  # Outputs for several targets at once, walking shared dependencies once
+  nodes = env.arg2nodes(targets, env.fs.Entry)
+  cache = _TargetOutputFilesCache(env, builders)
+  key = tuple(nodes)
+  rv = cache.get(key, None)
+  if rv is None:
+    rv = _TargetOutputFiles(env, nodes, builders, verbose)
+    cache[key] = rv
+  return list(rv)
 
 # 'targets' is a dictionary like the one returned by DeclareTargets function
 #           key=target name, value=list of SCons targets
@@ -2070,12 +3121,13 @@ def ConservativeClean(env, targetname, targets=None):
       if len(targetnames) == 0:
         # if not other target specified keep all of them
         targetnames = targets.keys()
+      keep = []
       for tn in targetnames:
         if tn == targetname or not tn in targets:
           continue
-        for target in targets[tn]:
-          for item in GetTargetOutputFiles(env, target):
-            env.NoClean(item)
+        keep.extend(targets[tn])
+      if keep:
+        env.NoClean(GetTargetsOutputFiles(env, keep))
 
 def EcosystemPlatform():
   if sys.platform == "darwin":
@@ -26,11 +26,14 @@
 import os
 import re
 import sys
+import time
 import glob
 import shutil
 import subprocess
 import excons
 import excons.devtoolset
+import excons.jobserver
+import excons.telemetry
 from excons.cmake import VC_Filter
 import SCons.Script # pylint: disable=import-error
 
@@ -62,6 +65,12 @@ def ConfigCachePath(name):
 def OutputsCachePath(name):
    return os.path.abspath(excons.out_dir + "/%s.automake.outputs" % name)
 
+def ConfigureLogPath(name):
+   return BuildDir(name) + "/configure.log"
+
+def BuildLogPath(name):
+   return BuildDir(name) + "/build.log"
+
 def Outputs(name):
    lst = []
    cof = OutputsCachePath(name)
@@ -100,41 +109,51 @@ def Configure(name, topdir=None, opts=None):
       if _env:
          env = os.environ.copy()
          env.update(_env)
+      launcher = excons.CompilerLauncher()
+      if launcher:
+         if env is None:
+            env = os.environ.copy()
+         env["CC"] = " ".join(launcher + [env.get("CC", "cc")])
+         env["CXX"] = " ".join(launcher + [env.get("CXX", "c++")])
 
-   excons.Print("Run Command: %s" % cmd, tool="automake")
-   p = subprocess.Popen(cmd, env=env, shell=True)
-   p.communicate()
+   return (excons.RunExternalCommand(cmd, ConfigureLogPath(name), env=env, tool="automake", name="configure") == 0)
 
-   return (p.returncode == 0)
+def ParseOutputLine(line, outfiles, symlinks):
+   line = line.strip()
+   # Cheap checks first, InstallExp requires 'install' and SymlinkExp 'ln'
+   if "install" in line:
+      m = InstallExp.match(line)
+   else:
+      m = None
+   if m is not None:
+      f = m.group(7)
+      if os.path.isdir(f):
+         items = filter(lambda y: len(y) > 0, map(lambda x: x.strip(), m.group(4).split(" ")))
+         for item in items:
+            o = f + "/" + os.path.basename(item)
+            outfiles.add(o)
+            #print("ADD - %s" % o)
+      else:
+         outfiles.add(f)
+         #print("ADD - %s" % f)
+   elif "ln" in line:
+      m = SymlinkExp.search(line)
+      if m:
+         srcdst = filter(lambda y: len(y) > 0, map(lambda x: x.strip(), m.group(3).split(" ")))
+         count = len(srcdst)
+         if count % 2 == 0:
+            mid = count / 2
+            src = " ".join(srcdst[:mid])
+            dst = " ".join(srcdst[mid:])
+            lst = symlinks.get(src, [])
+            lst.append(dst)
+            symlinks[src] = lst
+            #print("SYMLINK - %s -> %s" % (src, dst))
 
 def ParseOutputsInLines(lines, outfiles, symlinks):
    for line in lines:
       excons.Print(line, tool="automake")
-      m = InstallExp.match(line.strip())
-      if m is not None:
-         f = m.group(7)
-         if os.path.isdir(f):
-            items = filter(lambda y: len(y) > 0, map(lambda x: x.strip(), m.group(4).split(" ")))
-            for item in items:
-               o = f + "/" + os.path.basename(item)
-               outfiles.add(o)
-               #print("ADD - %s" % o)
-         else:
-            outfiles.add(f)
-            #print("ADD - %s" % f)
-      else:
-         m = SymlinkExp.search(line.strip())
-         if m:
-            srcdst = filter(lambda y: len(y) > 0, map(lambda x: x.strip(), m.group(3).split(" ")))
-            count = len(srcdst)
-            if count % 2 == 0:
-               mid = count / 2
-               src = " ".join(srcdst[:mid])
-               dst = " ".join(srcdst[mid:])
-               lst = symlinks.get(src, [])
-               lst.append(dst)
-               symlinks[src] = lst
-               #print("SYMLINK - %s -> %s" % (src, dst))
+      ParseOutputLine(line, outfiles, symlinks)
 
 def Build(name, target=None):
    if SCons.Script.GetOption("clean"):
@@ -153,8 +172,10 @@ def Build(name, target=None):
       target = "install"
    njobs = SCons.Script.GetOption("num_jobs")
 
+   jobserver = (excons.jobserver.Get() is not None)
+
    cmd = "cd \"%s\"; make" % BuildDir(name)
-   if njobs > 1:
+   if njobs > 1 and not jobserver:
       cmd += " -j %d" % njobs
    if excons.GetArgument("show-cmds", 0, int):
       cmd += " V=1"
@@ -166,20 +187,31 @@ def Build(name, target=None):
       if _env:
          env = os.environ.copy()
          env.update(_env)
+      if jobserver:
+         env = excons.jobserver.SetupEnv(env)
 
    excons.Print("Run Command: %s" % cmd, tool="automake")
-   p = subprocess.Popen(cmd, shell=True, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-
-   buf = ""
-   while p.poll() is None:
-      r = p.stdout.readline(512)
-      buf += r
-      lines = buf.split("\n")
-      if len(lines) > 1:
-         buf = lines[-1]
-         ParseOutputsInLines(lines[:-1], outfiles, symlinks)
-   ParseOutputsInLines(buf.split("\n"), outfiles, symlinks)
-   excons.Print(buf, tool="automake")
+
+   buildstart = time.time()
+
+   # Build uses one job slot, additional make jobs take tokens from job server
+   with excons.jobserver.Slot():
+      p = subprocess.Popen(cmd, shell=True, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, **excons.jobserver.PopenArgs())
+
+      log = excons.OpenExternalLog(BuildLogPath(name), tool="automake")
+      try:
+         for line in excons.StreamLines(p.stdout):
+            if log is not None:
+               log.write(line)
+            else:
+               excons.Print(line.rstrip("\r\n"), tool="automake")
+            ParseOutputLine(line, outfiles, symlinks)
+         cpu, rss = excons.telemetry.Wait(p)
+         excons.telemetry.Record("make", buildstart, time.time(), p.returncode, cpu=cpu, rss=rss, kind="automake")
+         excons.telemetry.SetCurrentTarget(None)
+      finally:
+         if log is not None:
+            log.close()
 
    if p.returncode == 0:
       with open(cof, "w") as f:
@@ -199,6 +231,8 @@ def Build(name, target=None):
          f.write("\n".join(excons.NormalizedRelativePaths(lst, excons.out_dir)))
       return True
    else:
+      if log is not None:
+         excons.Print("Build failed. See %s" % BuildLogPath(name), tool="automake")
       if os.path.isfile(cof):
          os.remove(cof)
       return False
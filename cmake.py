@@ -27,10 +27,15 @@ import os
 import re
 import sys
 import glob
+import time
+import pprint
 import shutil
+import hashlib
 import subprocess
 import excons
 import excons.devtoolset
+import excons.jobserver
+import excons.telemetry
 import SCons.Script # pylint: disable=import-error
 
 # pylint: disable=bad-indentation,global-statement,bare-except,deprecated-lambda
@@ -80,17 +85,123 @@ def ConfigCachePath(name):
 def OutputsCachePath(name):
    return os.path.abspath(excons.out_dir + "/%s.cmake.outputs" % name)
 
+def ConfigureLogPath(name):
+   return BuildDir(name) + "/configure.log"
+
+def BuildLogPath(name):
+   return BuildDir(name) + "/build.log"
+
+def InstallManifestPaths(name):
+   # One manifest per installed component (install_manifest_<component>.txt)
+   return glob.glob(BuildDir(name) + "/install_manifest*.txt")
+
+def ReadInstallManifest(name, since=None):
+   # Returns None when there's no manifest or when none was written after 'since'
+   paths = InstallManifestPaths(name)
+   if since is not None:
+      paths = filter(lambda x: os.path.getmtime(x) >= since, paths)
+   if not paths:
+      return None
+   rv = set()
+   for path in paths:
+      with open(path, "r") as f:
+         for line in f:
+            line = line.strip()
+            if line and not os.path.isdir(line):
+               rv.add(line)
+   return rv
+
+def _ReadOutputsCache(name):
+   cof = OutputsCachePath(name)
+   if not os.path.isfile(cof):
+      return None
+   with open(cof, "r") as f:
+      return filter(lambda y: len(y) > 0, map(lambda x: x.strip(), f.readlines()))
+
+def UpdateOutputs(name, outfiles):
+   # Only rewrite outputs cache when its content actually changes
+   lst = filter(VC_Filter, outfiles)
+   lst = sorted(set(excons.NormalizedRelativePaths(lst, excons.out_dir)))
+   prv = _ReadOutputsCache(name)
+   if prv is not None:
+      prv = set(prv)
+      if prv == set(lst):
+         # Mark cache as up to date with install manifest (see Outputs)
+         os.utime(OutputsCachePath(name), None)
+         return False
+      added = len(set(lst).difference(prv))
+      removed = len(prv.difference(lst))
+      excons.Print("Outputs changed (%d added, %d removed)" % (added, removed), tool="cmake")
+   with open(OutputsCachePath(name), "w") as f:
+      f.write("\n".join(lst))
+   return True
+
 def Outputs(name):
-   lst = []
+   lines = _ReadOutputsCache(name)
+   # Install manifest more recent than outputs cache (or cache missing), use it
    cof = OutputsCachePath(name)
-   if os.path.isfile(cof):
-      cofd = os.path.dirname(cof)
-      with open(cof, "r") as f:
-         lines = filter(lambda y: len(y)>0 and os.path.isfile(os.path.join(cofd, y)), map(lambda x: x.strip(), f.readlines()))
-         lst = filter(VC_Filter, map(lambda x: excons.out_dir + "/" + x, lines))
-   return lst
-
-def Configure(name, topdir=None, opts=None, min_mscver=None, flags=None):
+   manifest = ReadInstallManifest(name, since=(os.path.getmtime(cof) if lines is not None else None))
+   if manifest is not None:
+      lines = excons.NormalizedRelativePaths(manifest, excons.out_dir)
+   if lines is None:
+      return []
+   cofd = os.path.dirname(cof)
+   lines = filter(lambda y: os.path.isfile(os.path.join(cofd, y)), lines)
+   return filter(VC_Filter, map(lambda x: excons.out_dir + "/" + x, lines))
+
+def ToolchainState(min_mscver=None):
+   # Settings that require a cold configure (i.e. new CMakeCache.txt) when changed
+   rv = {"cmake": excons.GetArgument("with-cmake", "cmake")}
+   if sys.platform == "win32":
+      rv["mscver"] = excons.GetArgument("mscver", "10.0")
+      rv["min_mscver"] = min_mscver
+   else:
+      rv["devtoolset"] = excons.GetArgument("devtoolset", "")
+   for k in ("CC", "CXX"):
+      rv[k] = os.environ.get(k, "")
+   return rv
+
+def ConfigState(opts, flags, cfgs, min_mscver=None):
+   cfgsums = {}
+   for path in map(str, cfgs):
+      try:
+         with open(path, "rb") as f:
+            cfgsums[path] = hashlib.md5(f.read()).hexdigest()
+      except:
+         cfgsums[path] = None
+   state = {"opts": opts,
+            "flags": flags,
+            "toolchain": ToolchainState(min_mscver),
+            "launcher": excons.CompilerLauncher(),
+            "cfgs": cfgsums}
+   # pprint output is sorted by keys, thus stable
+   state["digest"] = hashlib.md5(pprint.pformat(state)).hexdigest()
+   return state
+
+def ReadConfigState(path):
+   # Returns None for missing, invalid or older (options only) config cache
+   if not os.path.isfile(path):
+      return None
+   with open(path, "r") as f:
+      try:
+         d = eval(f.read()) # pylint: disable=eval-used
+      except:
+         return None
+   if type(d) != dict or not "digest" in d:
+      return None
+   return d
+
+def WriteConfigState(path, state):
+   with open(path, "w") as f:
+      pprint.pprint(state, stream=f)
+
+def ConfigOptionsChanges(oldopts, newopts):
+   # Returns options to set and options to unset to go from oldopts to newopts
+   changed = dict(filter(lambda x: not x[0] in oldopts or oldopts[x[0]] != x[1], newopts.iteritems()))
+   removed = filter(lambda x: not x in newopts, oldopts.keys())
+   return (changed, removed)
+
+def Configure(name, topdir=None, opts=None, min_mscver=None, flags=None, unset=None):
    if SCons.Script.GetOption("clean"):
       return True
 
@@ -140,6 +251,9 @@ def Configure(name, topdir=None, opts=None, min_mscver=None, flags=None):
       cmd += flags
       if not flags.endswith(" "):
          cmd += " "
+   if unset:
+      for k in unset:
+         cmd += "-U%s " % k
    for k, v in opts.iteritems():
       cmd += "-D%s=%s " % (k, ("\"%s\"" % v if type(v) in (str, unicode) else v))
    cmd += "-DCMAKE_INSTALL_PREFIX=\"%s\" "  % excons.OutputBaseDirectory()
@@ -149,23 +263,30 @@ def Configure(name, topdir=None, opts=None, min_mscver=None, flags=None):
       cmd += "-DCMAKE_INSTALL_RPATH_USE_LINK_PATH=0 "
       if sys.platform == "darwin":
          cmd += "-DCMAKE_MACOSX_RPATH=1 "
+      # Always set so that disabling compiler cache also applies to existing builds
+      launcher = excons.CompilerLauncher()
+      launcher = (";".join(launcher) if launcher else "")
+      cmd += "-DCMAKE_C_COMPILER_LAUNCHER=\"%s\" " % launcher
+      cmd += "-DCMAKE_CXX_COMPILER_LAUNCHER=\"%s\" " % launcher
    cmd += relpath
 
-   excons.Print("Run Command: %s" % cmd, tool="cmake")
-   p = subprocess.Popen(cmd, env=env, shell=True)
-   p.communicate()
+   return (excons.RunExternalCommand(cmd, ConfigureLogPath(name), env=env, tool="cmake", name="cmake") == 0)
 
-   return (p.returncode == 0)
-
-def ParseOutputsInLines(lines, outfiles):
-   for line in lines:
-      excons.Print(line, tool="cmake")
-      m = InstallExp.match(line.strip())
+def ParseOutputLine(line, outfiles):
+   line = line.strip()
+   # Cheap check first, InstallExp lines start with '--'
+   if line.startswith("--"):
+      m = InstallExp.match(line)
       if m is not None:
          f = m.group(2)
          if not os.path.isdir(f):
             outfiles.add(f)
 
+def ParseOutputsInLines(lines, outfiles):
+   for line in lines:
+      excons.Print(line, tool="cmake")
+      ParseOutputLine(line, outfiles)
+
 def Build(name, config=None, target=None):
    if SCons.Script.GetOption("clean"):
       return True
@@ -187,9 +308,12 @@ def Build(name, config=None, target=None):
    cmd = "cd \"%s\" %s %s --build . --config %s --target %s" % (BuildDir(name), CmdSep, excons.GetArgument("with-cmake", "cmake"), config, target)
    env = None
 
+   # Makefile generators share excons job server instead of running their own -j
+   jobserver = (sys.platform != "win32" and excons.jobserver.Get() is not None and os.path.isfile(BuildDir(name) + "/Makefile"))
+
    extraargs = ""
    njobs = SCons.Script.GetOption("num_jobs")
-   if njobs > 1:
+   if njobs > 1 and not jobserver:
       if sys.platform == "win32":
          extraargs += " /m:%d" % njobs
       else:
@@ -210,29 +334,47 @@ def Build(name, config=None, target=None):
       if _env:
          env = os.environ.copy()
          env.update(_env)
+      if jobserver:
+         env = excons.jobserver.SetupEnv(env)
 
    excons.Print("Run Command: %s" % cmd, tool="cmake")
-   p = subprocess.Popen(cmd, shell=True, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-
-   buf = ""
-   while p.poll() is None:
-      r = p.stdout.readline(512)
-      buf += r
-      lines = buf.split("\n")
-      if len(lines) > 1:
-         buf = lines[-1]
-         ParseOutputsInLines(lines[:-1], outfiles)
-   ParseOutputsInLines(buf.split("\n"), outfiles)
-   excons.Print(buf, tool="cmake")
+
+   # Truncate for filesystems with coarse mtime resolution
+   started = int(time.time())
+
+   buildstart = time.time()
+
+   # Build uses one job slot, additional make jobs take tokens from job server
+   with excons.jobserver.Slot():
+      p = subprocess.Popen(cmd, shell=True, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, **excons.jobserver.PopenArgs())
+
+      log = excons.OpenExternalLog(BuildLogPath(name), tool="cmake")
+      try:
+         for line in excons.StreamLines(p.stdout):
+            if log is not None:
+               log.write(line)
+            else:
+               excons.Print(line.rstrip("\r\n"), tool="cmake")
+            ParseOutputLine(line, outfiles)
+         cpu, rss = excons.telemetry.Wait(p)
+         excons.telemetry.Record("cmake", buildstart, time.time(), p.returncode, cpu=cpu, rss=rss, kind="cmake")
+         excons.telemetry.SetCurrentTarget(None)
+      finally:
+         if log is not None:
+            log.close()
 
    # Write list of outputed files
    if p.returncode == 0:
-      with open(cof, "w") as f:
-         lst = filter(VC_Filter, outfiles)
-         lst.sort()
-         f.write("\n".join(excons.NormalizedRelativePaths(lst, excons.out_dir)))
+      # CMake's install manifest is authoritative, stdout is only a fallback
+      #   (i.e. target doesn't run install rules)
+      manifest = ReadInstallManifest(name, since=started)
+      if manifest is not None:
+         outfiles = manifest
+      UpdateOutputs(name, outfiles)
       return True
    else:
+      if log is not None:
+         excons.Print("Build failed. See %s" % BuildLogPath(name), tool="cmake")
       if os.path.isfile(cof):
          os.remove(cof)
       return False
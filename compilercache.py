@@ -0,0 +1,329 @@
+# MIT License
+#
+# Copyright (c) 2021 Gaetan Guidet
+#
+# This file is part of excons.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import os
+import sys
+import shutil
+import hashlib
+import tempfile
+import threading
+import subprocess
+
+# pylint: disable=bad-indentation,broad-except,bare-except
+
+
+# Local content-addressed object cache for gcc/clang style compilers
+#
+# Entries are keyed on compiler identity (path, size, mtime), full command line
+#   and preprocessed source. Each entry is a directory holding the object ('o'),
+#   the dependency file ('d', when -MD/-MMD is used) and the compiler messages ('e').
+#   Entries are spread in 256 sub-directories, each bounded to 1/256th of the
+#   cache size, least recently used entries being evicted first.
+#
+# Can also be used as a compiler launcher:
+#   python compilercache.py [--dir=<path>] [--max-size=<bytes>] <compiler> <args...>
+
+DefaultDir = os.path.expanduser("~/.excons/compiler-cache")
+DefaultMaxSize = 5 * 1024 * 1024 * 1024
+
+# Flags for which objects can't be restored from cache
+Uncacheable = set(["-M", "-MM", "-E", "-S", "-save-temps", "--coverage", "-gsplit-dwarf",
+                   "-fprofile-arcs", "-ftest-coverage", "-fprofile-generate"])
+
+Stats = {"hits": 0, "misses": 0, "uncacheable": 0}
+
+_Lock = threading.Lock()
+_CompilerIds = {}
+
+
+def _Count(key):
+  with _Lock:
+    Stats[key] += 1
+
+def _FindExecutable(name, env):
+  if os.path.isabs(name) or os.sep in name:
+    return (name if os.path.isfile(name) else None)
+  for d in (env if env is not None else os.environ).get("PATH", "").split(os.pathsep):
+    path = os.path.join(d, name)
+    if os.path.isfile(path):
+      return path
+  return None
+
+def _CompilerId(name, env):
+  with _Lock:
+    rv = _CompilerIds.get(name, None)
+  if rv is None:
+    path = _FindExecutable(name, env)
+    if path is None:
+      return None
+    st = os.stat(os.path.realpath(path))
+    rv = "%s:%d:%d" % (os.path.realpath(path), st.st_size, int(st.st_mtime))
+    with _Lock:
+      _CompilerIds[name] = rv
+  return rv
+
+def _MakeQuote(path):
+  return path.replace("$", "$$").replace(" ", "\\ ")
+
+def _ParseArgs(args):
+  # Returns (object path, dependency file path, dependency file target,
+  #          preprocessor arguments, key arguments)
+  #   or None when command isn't a cacheable compilation
+  # Key arguments have output paths replaced by placeholders so that
+  #   entries can be shared across build directories
+  obj, depfile, deps, compile_only = None, None, False, False
+  targets = []
+  ppargs = [args[0]]
+  keyargs = [args[0]]
+  i = 1
+  n = len(args)
+  while i < n:
+    a = args[i]
+    if a in Uncacheable or a.startswith("-fprofile-"):
+      return None
+    elif a == "-c":
+      compile_only = True
+      keyargs.append(a)
+    elif a == "-o":
+      if i + 1 >= n:
+        return None
+      i += 1
+      obj = args[i]
+      keyargs.extend([a, "<obj>"])
+    elif a.startswith("-o"):
+      obj = a[2:]
+      keyargs.append("-o<obj>")
+    elif a in ("-MD", "-MMD"):
+      deps = True
+      keyargs.append(a)
+    elif a in ("-MF", "-MT", "-MQ"):
+      if i + 1 >= n:
+        return None
+      i += 1
+      if a == "-MF":
+        depfile = args[i]
+      elif a == "-MT":
+        targets.append(args[i])
+      else:
+        targets.append(_MakeQuote(args[i]))
+      keyargs.extend([a, "<%s>" % a[1:]])
+    elif a.startswith("-MF"):
+      depfile = a[3:]
+      keyargs.append("-MF<MF>")
+    elif a.startswith("-MT"):
+      targets.append(a[3:])
+      keyargs.append("-MT<MT>")
+    elif a.startswith("-MQ"):
+      targets.append(_MakeQuote(a[3:]))
+      keyargs.append("-MQ<MQ>")
+    else:
+      ppargs.append(a)
+      keyargs.append(a)
+    i += 1
+  if not compile_only or not obj:
+    return None
+  if not deps:
+    depfile = None
+  elif depfile is None:
+    depfile = os.path.splitext(obj)[0] + ".d"
+  deptarget = (" ".join(targets) if targets else _MakeQuote(obj))
+  return (obj, depfile, deptarget, ppargs + ["-E"], keyargs)
+
+def _Digest(args, env, ppout):
+  cid = _CompilerId(args[0], env)
+  if cid is None:
+    return None
+  h = hashlib.sha1()
+  h.update(cid.encode("utf-8"))
+  h.update(b"\0")
+  h.update("\0".join(args).encode("utf-8"))
+  h.update(b"\0")
+  # Debug information embeds compilation directory
+  if [x for x in args if x.startswith("-g") and x != "-g0"]:
+    h.update(os.getcwd().encode("utf-8"))
+    h.update(b"\0")
+  h.update(ppout)
+  return h.hexdigest()
+
+def _Run(args, env):
+  p = subprocess.Popen(args, env=env, stderr=subprocess.PIPE)
+  _, err = p.communicate()
+  return (p.returncode, err)
+
+def _WriteMessages(err):
+  if err:
+    if hasattr(sys.stderr, "buffer"):
+      sys.stderr.buffer.write(err)
+    else:
+      sys.stderr.write(err)
+    sys.stderr.flush()
+
+def _RestoreDepfile(path, depfile, deptarget):
+  # Rule target is the output path of the command that stored the entry
+  with open(path, "rb") as f:
+    data = f.read()
+  pos = data.find(b": ")
+  if pos != -1:
+    data = deptarget.encode("utf-8") + data[pos:]
+  with open(depfile, "wb") as f:
+    f.write(data)
+
+def _Restore(entry, obj, depfile, deptarget):
+  if not os.path.isfile(entry + "/o") or (depfile and not os.path.isfile(entry + "/d")):
+    return None
+  try:
+    shutil.copyfile(entry + "/o", obj)
+    if depfile:
+      _RestoreDepfile(entry + "/d", depfile, deptarget)
+    with open(entry + "/e", "rb") as f:
+      err = f.read()
+    # Mark entry as recently used
+    os.utime(entry + "/o", None)
+    return err
+  except:
+    return None
+
+def _Store(entry, obj, depfile, err, maxsize):
+  subdir = os.path.dirname(entry)
+  try:
+    if not os.path.isdir(subdir):
+      os.makedirs(subdir)
+    tmp = tempfile.mkdtemp(dir=subdir, prefix=".tmp")
+    shutil.copyfile(obj, tmp + "/o")
+    if depfile:
+      shutil.copyfile(depfile, tmp + "/d")
+    with open(tmp + "/e", "wb") as f:
+      f.write(err)
+    try:
+      os.rename(tmp, entry)
+    except:
+      # Concurrently stored
+      shutil.rmtree(tmp, ignore_errors=True)
+  except:
+    return
+  Trim(subdir, maxsize)
+
+def _EntrySize(entry):
+  size = 0
+  for name in ("o", "d", "e"):
+    try:
+      size += os.path.getsize(entry + "/" + name)
+    except:
+      pass
+  return size
+
+def Trim(subdir, maxsize):
+  # Evict least recently used entries from one cache sub-directory
+  limit = maxsize // 256
+  entries = []
+  total = 0
+  for name in os.listdir(subdir):
+    if name.startswith(".tmp"):
+      continue
+    entry = subdir + "/" + name
+    try:
+      atime = os.path.getmtime(entry + "/o")
+    except:
+      atime = 0
+    size = _EntrySize(entry)
+    entries.append((atime, size, entry))
+    total += size
+  if total <= limit:
+    return
+  entries.sort()
+  # Leave some room so that trimming doesn't happen on every store
+  limit = int(limit * 0.9)
+  for _, size, entry in entries:
+    if total <= limit:
+      break
+    shutil.rmtree(entry, ignore_errors=True)
+    total -= size
+
+def Compile(args, cachedir=None, maxsize=None, env=None):
+  # Run compiler command line 'args' through the cache, returns exit code
+  if cachedir is None:
+    cachedir = DefaultDir
+  if maxsize is None:
+    maxsize = DefaultMaxSize
+
+  parsed = _ParseArgs(args)
+  if parsed is None:
+    _Count("uncacheable")
+    rv, err = _Run(args, env)
+    _WriteMessages(err)
+    return rv
+
+  obj, depfile, deptarget, ppargs, keyargs = parsed
+
+  p = subprocess.Popen(ppargs, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+  ppout, _ = p.communicate()
+  key = (_Digest(keyargs, env, ppout) if p.returncode == 0 else None)
+  if key is None:
+    # Let the compiler report errors
+    _Count("uncacheable")
+    rv, err = _Run(args, env)
+    _WriteMessages(err)
+    return rv
+
+  entry = os.path.join(cachedir, key[:2], key[2:])
+
+  err = _Restore(entry, obj, depfile, deptarget)
+  if err is not None:
+    _Count("hits")
+    _WriteMessages(err)
+    return 0
+
+  _Count("misses")
+  rv, err = _Run(args, env)
+  _WriteMessages(err)
+  if rv == 0:
+    _Store(entry, obj, depfile, err, maxsize)
+  return rv
+
+def LauncherArgs(cachedir, maxsize):
+  # Command line prefix to use this module as a compiler launcher
+  return [sys.executable, os.path.splitext(os.path.abspath(__file__))[0] + ".py", "--dir=%s" % cachedir, "--max-size=%d" % maxsize]
+
+def ParseLauncherArgs(args):
+  # Returns (cache directory, maximum size, compiler command line)
+  cachedir, maxsize = DefaultDir, DefaultMaxSize
+  while args and args[0].startswith("--"):
+    if args[0].startswith("--dir="):
+      cachedir = args[0][6:]
+    elif args[0].startswith("--max-size="):
+      maxsize = int(args[0][11:])
+    args = args[1:]
+  return (cachedir, maxsize, args)
+
+def Main(args):
+  cachedir, maxsize, args = ParseLauncherArgs(args)
+  if not args:
+    sys.stderr.write("Usage: compilercache.py [--dir=<path>] [--max-size=<bytes>] <compiler> <args...>\n")
+    return 1
+  return Compile(args, cachedir=cachedir, maxsize=maxsize)
+
+
+if __name__ == "__main__":
+  sys.exit(Main(sys.argv[1:]))
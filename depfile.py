@@ -0,0 +1,225 @@
+# MIT License
+#
+# Copyright (c) 2021 Gaetan Guidet
+#
+# This file is part of excons.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import os
+import re
+import sys
+import atexit
+import tempfile
+
+# pylint: disable=bad-indentation,global-statement,bare-except,unused-argument
+
+
+# Compiler generated header dependencies, enabled by 'header-deps=depfile' flag
+#
+# Objects are compiled with '-MMD -MF <object>.d' (gcc/clang) or '/showIncludes'
+#   (msvc, compiler output is filtered and written to '<object>.d').
+#   Dependency files are parsed after each compile and stored in the build
+#   directory ('depfiles' cache: a path table and a list of path indices per object).
+# For objects with a recorded entry, SCons C scanner isn't used: the recorded
+#   headers are the object implicit dependencies. Other objects (first build,
+#   cache cleared) fall back to the regular scanner.
+
+ShowIncludesPrefix = "Note: including file:"
+
+_Deps = None
+_Dirty = False
+
+
+def Enabled():
+  import excons
+  return (excons.GetArgument("header-deps", "scanner") == "depfile")
+
+def _MSVC():
+  import SCons.Script # pylint: disable=import-error
+  return (str(SCons.Script.Platform()) == "win32")
+
+def _NormPath(path):
+  return os.path.abspath(path).replace("\\", "/")
+
+def _ReadDeps():
+  global _Deps
+
+  if _Deps is None:
+    import excons
+    data = excons.ReadPersistentCache("depfiles")
+    paths = data.get("paths", [])
+    _Deps = {}
+    for obj, indices in data.get("objs", {}).iteritems():
+      _Deps[obj] = frozenset([paths[i] for i in indices])
+    atexit.register(_WriteDeps)
+
+  return _Deps
+
+def _WriteDeps():
+  if not _Dirty:
+    return
+
+  import excons
+
+  paths = []
+  index = {}
+  objs = {}
+  for obj, deps in _Deps.iteritems():
+    indices = []
+    for dep in sorted(deps):
+      i = index.get(dep, None)
+      if i is None:
+        i = len(paths)
+        index[dep] = i
+        paths.append(dep)
+      indices.append(i)
+    objs[obj] = indices
+
+  excons.WritePersistentCache("depfiles", {"paths": paths, "objs": objs})
+
+def Dependencies(obj):
+  # Recorded headers for object path, None if unknown
+  if not obj:
+    return None
+  return _ReadDeps().get(obj, None)
+
+def Parse(path):
+  # make rule syntax: '<target>: <dep> <dep> \'
+  try:
+    with open(path, "r") as f:
+      data = f.read()
+  except:
+    return None
+
+  data = data.replace("\\\r\n", " ").replace("\\\n", " ")
+  pos = data.find(": ")
+  if pos == -1:
+    return []
+
+  return [x.replace("\\ ", " ") for x in re.findall(r"(?:\\ |\S)+", data[pos+2:])]
+
+def _Write(path, target, deps):
+  with open(path, "w") as f:
+    f.write("%s:" % target.replace(" ", "\\ "))
+    for dep in deps:
+      f.write(" \\\n  %s" % dep.replace(" ", "\\ "))
+    f.write("\n")
+
+def UpdateAction(target, source, env):
+  global _Dirty
+
+  deps = _ReadDeps()
+  srcs = set([_NormPath(str(x)) for x in source])
+
+  for t in target:
+    obj = _NormPath(str(t))
+    lst = Parse(obj + ".d")
+    if lst is None:
+      # No dependency file, scan on next build
+      if deps.pop(obj, None) is not None:
+        _Dirty = True
+      continue
+    lst = frozenset([_NormPath(x) for x in lst]).difference(srcs)
+    if deps.get(obj, None) != lst:
+      deps[obj] = lst
+      _Dirty = True
+
+  return 0
+
+def ShowIncludesSpawn(spawn, pspawn):
+  # Filter msvc '/showIncludes' output into '<object>.d' file
+  def DepfileSpawn(sh, escape, cmd, args, env):
+    objs = [x.strip("\"")[3:] for x in args if x.strip("\"").startswith("/Fo")]
+    if not "/showIncludes" in args or len(objs) != 1:
+      return spawn(sh, escape, cmd, args, env)
+
+    fd, outpath = tempfile.mkstemp(suffix=".txt")
+    os.close(fd)
+    try:
+      with open(outpath, "w") as out:
+        rv = pspawn(sh, escape, cmd, args, env, out, out)
+      deps = []
+      with open(outpath, "r") as out:
+        for line in out:
+          if line.startswith(ShowIncludesPrefix):
+            deps.append(line[len(ShowIncludesPrefix):].strip())
+          else:
+            sys.stdout.write(line)
+    finally:
+      try:
+        os.remove(outpath)
+      except:
+        pass
+
+    if rv == 0:
+      _Write(objs[0] + ".d", objs[0], deps)
+
+    return rv
+
+  return DepfileSpawn
+
+def ObjectOverrides(objpath):
+  # Builder keyword arguments for object compiled to objpath
+  if not Enabled():
+    return {}
+  objpath = _NormPath(objpath)
+  flags = (["/showIncludes"] if _MSVC() else ["-MMD", "-MF", objpath + ".d"])
+  return {"DEPFILE_FLAGS": flags, "DEPFILE_OBJECT": objpath}
+
+def AddObject(env, obj):
+  if not Enabled():
+    return
+  import SCons.Script # pylint: disable=import-error
+  env.AddPostAction(obj, SCons.Script.Action(UpdateAction, None))
+  env.Clean(obj, [str(x) + ".d" for x in obj])
+
+def Scanner(fallback):
+  import SCons.Scanner # pylint: disable=import-error
+
+  def DepfileScan(node, env, path):
+    deps = Dependencies(env.get("DEPFILE_OBJECT", None))
+    if deps is None:
+      return fallback(node, env, path)
+    if _NormPath(node.get_abspath()) in deps:
+      # Recorded list is already complete
+      return []
+    return [env.File(x) for x in sorted(deps) if os.path.isfile(x)]
+
+  return SCons.Scanner.Base(DepfileScan, "DepfileScanner", skeys="$CPPSUFFIXES",
+                            path_function=SCons.Scanner.FindPathDirs("CPPPATH"), recursive=True)
+
+def Setup(env, fallback=None):
+  # fallback: scanner for objects without recorded dependencies
+  if not Enabled():
+    return
+
+  import excons
+
+  if fallback is None:
+    import SCons.Scanner.C # pylint: disable=import-error
+    fallback = SCons.Scanner.C.CScanner()
+
+  env["DEPFILE_FLAGS"] = []
+  env.Append(CCFLAGS=["$DEPFILE_FLAGS"])
+  excons.SetObjectSourceScanner(env, Scanner(fallback))
+
+  if _MSVC():
+    env["SPAWN"] = ShowIncludesSpawn(env["SPAWN"], env["PSPAWN"])
@@ -23,24 +23,60 @@
 # SOFTWARE.
 
 
+
 import os
 import re
 import sys
 import subprocess
 
-# pylint: disable=bad-indentation,deprecated-lambda
+# pylint: disable=bad-indentation,deprecated-lambda,global-statement,bare-except
 
 
 _VarsCache = {}
+_GCCVerCache = {}
+_PersistentCache = None
 
 # Note: GCC>=5 on linux breaks stdc++ library ABI
 #       the "_GLIBCXX_USE_CXX11_ABI" can be set to revert it to the old ABI
 #       -> "-D_GLIBCXX_USE_CXX11_ABI=0"
 
+def _MTime(path):
+  try:
+    return os.stat(path).st_mtime
+  except:
+    return None
+
+def _ReadPersistentCache(key):
+  global _PersistentCache
+
+  if _PersistentCache is None:
+    import excons
+    _PersistentCache = excons.ReadPersistentCache("devtoolset")
+
+  return _PersistentCache.get(key, None)
+
+def _WritePersistentCache(key, value):
+  import excons
+
+  _ReadPersistentCache(key)
+  _PersistentCache[key] = value
+  excons.WritePersistentCache("devtoolset", _PersistentCache)
+
+def _EnableScriptKey(toolsetname):
+  # Persistent cache entries are only valid for a given state of the SCL enable script
+  mtime = _MTime("/opt/rh/%s/enable" % toolsetname)
+  if mtime is None:
+    return None
+  return "%s:%s" % (toolsetname, mtime)
+
 def GetDevtoolsetEnv(toolsetver, merge=False):
   if toolsetver and sys.platform.startswith("linux"):
     toolsetname = "devtoolset-%s" % toolsetver
     ret = _VarsCache.get(toolsetname, None)
+    if ret is None:
+      key = _EnableScriptKey(toolsetname)
+      if key is not None:
+        ret = _ReadPersistentCache("env:" + key)
     if ret is None:
       ret = {}
       p = subprocess.Popen("scl enable %s env" % toolsetname, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
@@ -49,10 +85,13 @@ def GetDevtoolsetEnv(toolsetver, merge=False):
         lines = filter(lambda y: toolsetname in y, map(lambda x: x.strip(), out.split("\n")))
         matches = filter(lambda y: y is not None, map(lambda x: re.match("^([^=]+)=(.*)$", x), lines))
         ret = dict([(m.group(1), filter(lambda w: toolsetname in w, m.group(2).split(os.pathsep))) for m in matches])
+        key = _EnableScriptKey(toolsetname)
+        if key is not None:
+          _WritePersistentCache("env:" + key, ret)
       else:
         print("Invalid devtoolset: %s (%s)" % (toolsetname, toolsetver))
         sys.exit(1)
-      _VarsCache[toolsetname] = ret
+    _VarsCache[toolsetname] = ret
     if ret:
       env = {}
       for k, v in ret.iteritems():
@@ -60,7 +99,8 @@ def GetDevtoolsetEnv(toolsetver, merge=False):
           _v = os.environ.get(k, None)
           if _v is not None:
             vals = filter(lambda y: len(y) > 0, map(lambda x: x.strip(), _v.split(os.pathsep)))
-            v.extend(vals)
+            # Don't modify cached list
+            v = v + vals
         env[k] = os.pathsep.join(v)
       return env
   return {}
@@ -71,9 +111,29 @@ def GetGCCFullVer(toolsetver):
   if _vars:
     _env = os.environ.copy()
     _env.update(_vars)
+    key = _EnableScriptKey("devtoolset-%s" % toolsetver)
+  else:
+    import excons
+    gcc = excons.Which("gcc")
+    key = (None if gcc is None else "%s:%s" % (gcc, _MTime(gcc)))
+
+  if key is not None:
+    key = "gccver:" + key
+    rv = _GCCVerCache.get(key, None)
+    if rv is None:
+      rv = _ReadPersistentCache(key)
+      if rv is not None:
+        _GCCVerCache[key] = rv
+    if rv is not None:
+      return rv
+
   p = subprocess.Popen(["gcc", "-dumpversion"], env=_env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
   out, _ = p.communicate()
   if p.returncode == 0:
-    return out.strip()
+    rv = out.strip()
+    if key is not None:
+      _GCCVerCache[key] = rv
+      _WritePersistentCache(key, rv)
+    return rv
   else:
     return None
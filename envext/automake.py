@@ -26,7 +26,6 @@
 import os
 import sys
 import pprint
-import subprocess
 import excons
 import excons.automake as automake
 import SCons.Script # pylint: disable=import-error
@@ -41,6 +40,8 @@ def AutoconfAction(target, source, env):
    configure = env["AUTOMAKE_CONFIGURE"]
    autogen = env["AUTOMAKE_AUTOGEN"]
 
+   cmd = None
+
    if os.path.isfile(autogen):
       cmd = "sh %s" % autogen
 
@@ -49,10 +50,9 @@ def AutoconfAction(target, source, env):
 
    if cmd is not None:
       cmd = "cd \"%s\"; %s" % (env["AUTOMAKE_TOPDIR"], cmd)
-      excons.Print("Run Command: %s" % cmd, tool="automake")
-      p = subprocess.Popen(cmd, shell=True)
-      p.communicate()
-      if p.returncode != 0 or not os.path.isfile(configure):
+      logpath = automake.BuildDir(env["AUTOMAKE_PROJECT"]) + "/autoconf.log"
+      ret = excons.RunExternalCommand(cmd, logpath, tool="automake", name="autoconf")
+      if ret != 0 or not os.path.isfile(configure):
          raise Exception("Failed to generate Automake 'configure' file")
 
    return None
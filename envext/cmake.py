@@ -25,23 +25,39 @@
 
 import os
 import excons
-import pprint
 import excons.cmake as cmake
 import SCons.Script # pylint: disable=import-error
 
-# pylint: disable=bad-indentation,deprecated-lambda,unused-argument,bare-except,eval-used
+# pylint: disable=bad-indentation,deprecated-lambda,unused-argument,bare-except
 
 
 def DummyScanner(node, env, path):
    return []
 
 def ConfigureAction(target, source, env):
-   if not cmake.Configure(env["CMAKE_PROJECT"], topdir=env["CMAKE_TOPDIR"], opts=env["CMAKE_OPTIONS"], flags=env["CMAKE_FLAGS"], min_mscver=env["CMAKE_MIN_MSCVER"]):
+   state = env["CMAKE_CONFIG_STATE"]
+   opts = state["opts"]
+   unset = []
+
+   # Compare with last successful configure state
+   prev = cmake.ReadConfigState(env["CMAKE_CONFIG_CACHE"])
+   if prev is None or not os.path.isfile(env["CMAKE_CACHE"]) or \
+      prev["flags"] != state["flags"] or prev["toolchain"] != state["toolchain"]:
+      # Cold configure
+      if os.path.isfile(env["CMAKE_CACHE"]):
+         os.remove(env["CMAKE_CACHE"])
+   else:
+      # Re-run on top of existing CMakeCache.txt with changed options only
+      opts, unset = cmake.ConfigOptionsChanges(prev["opts"], opts)
+
+   if not cmake.Configure(env["CMAKE_PROJECT"], topdir=env["CMAKE_TOPDIR"], opts=opts, flags=env["CMAKE_FLAGS"], min_mscver=env["CMAKE_MIN_MSCVER"], unset=unset):
       if os.path.isfile(env["CMAKE_CONFIG_CACHE"]):
          os.remove(env["CMAKE_CONFIG_CACHE"])
       if os.path.isfile(env["CMAKE_CACHE"]):
          os.remove(env["CMAKE_CACHE"])
       raise Exception("CMake Configure Failed")
+
+   cmake.WriteConfigState(env["CMAKE_CONFIG_CACHE"], state)
    return None
 
 def BuildAction(target, source, env):
@@ -64,9 +80,9 @@ def SetupEnvironment(env, settings):
    env.Prepend(SCANNERS=SCons.Script.Scanner(function=DummyScanner, skeys=cexts))
    env["CMAKE_PROJECT"] = name
    env["CMAKE_TOPDIR"] = excons.abspath(settings.get("cmake-root", "."))
-   env["CMAKE_OPTIONS"] = opts
    env["CMAKE_FLAGS"] = flags
    env["CMAKE_MIN_MSCVER"] = settings.get("cmake-min-mscver", None)
+   env["CMAKE_CONFIG_STATE"] = cmake.ConfigState(opts, flags, settings.get("cmake-cfgs", []), min_mscver=env["CMAKE_MIN_MSCVER"])
    env["CMAKE_CONFIG"] = settings.get("cmake-config", ("debug" if debug else "release"))
    env["CMAKE_TARGET"] = settings.get("cmake-target", "install")
    env["CMAKE_CACHE"] = cmakec
@@ -82,37 +98,19 @@ def SetupEnvironment(env, settings):
          except:
             return None
 
-      doconf = True
-      if os.path.isfile(cfgc):
-         doconf = False
-         with open(cfgc, "r") as f:
-            try:
-               d = eval(f.read())
-               for k, v in d.iteritems():
-                  if not k in opts or opts[k] != v:
-                     doconf = True
-                     break
-               if not doconf:
-                  for k, v in opts.iteritems():
-                     if not k in d:
-                        doconf = True
-                        break
-            except:
-               doconf = True
-      if doconf or int(SCons.Script.ARGUMENTS.get("reconfigure", "0")) != 0:
-         # Only rewrite cfgc when strictly needed
-         if doconf:
-            with open(cfgc, "w") as f:
-               pprint.pprint(opts, stream=f)
-         if os.path.isfile(cmakec):
-            os.remove(cmakec)
+      if int(SCons.Script.ARGUMENTS.get("reconfigure", "0")) != 0 and os.path.isfile(cmakec):
+         os.remove(cmakec)
 
+   # Configuration state is only written by a successful configure (see ConfigureAction)
+   #   configure step depends on its digest so that it runs when state changes
    cins = settings.get("cmake-cfgs", [])
-   cins.append(cfgc)
+   cins.append(env.Value(env["CMAKE_CONFIG_STATE"]["digest"]))
    cins.extend(cmake.AdditionalConfigureDependencies(name))
    cout = [cmakec]
 
    env.CMakeConfigure(cout, cins)
+   # Keep CMakeCache.txt until ConfigureAction decides between cold and partial configure
+   env.Precious(cout)
 
    bins = settings.get("cmake-srcs", [])
    bins.extend(cout)
@@ -0,0 +1,161 @@
+# MIT License
+#
+# Copyright (c) 2021 Gaetan Guidet
+#
+# This file is part of excons.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import os
+import sys
+import atexit
+
+# pylint: disable=bad-indentation,global-statement,bare-except
+
+
+# Persistent header scan cache, enabled by 'header-cache=1' flag
+#
+# Include directories of external SDKs (as returned by GetDirs or
+#   ExternalLibRequire) are considered immutable for a given version:
+#   the include directives of their headers are read once and persisted in the
+#   build directory ('headers' cache). Changing a directory version (its
+#   modification time, or the library file modification time when registered
+#   through ExternalLibRequire) drops the directory entries.
+# Headers outside of those directories (project headers) are scanned as usual.
+
+_Dirs = {}
+_SortedDirs = None
+_Cache = None
+_Dirty = False
+
+
+def Enabled():
+  import excons
+  return (excons.GetArgument("header-cache", 0, int) != 0)
+
+def _NormPath(path):
+  path = os.path.abspath(path).replace("\\", "/")
+  return (path.lower() if sys.platform == "win32" else path)
+
+def _Version(path):
+  try:
+    return str(int(os.stat(path).st_mtime))
+  except:
+    return None
+
+def AddImmutableDir(path, version=None, versionfile=None):
+  # version: explicit version string
+  # versionfile: file whose modification time acts as version
+  #   (defaults to the directory itself)
+  global _SortedDirs
+
+  import excons
+
+  if not path or not os.path.isdir(path):
+    return
+
+  d = _NormPath(path)
+  
+  # Ignore directories that may be modified by the build
+  for root in (excons.out_dir, os.getcwd()):
+    root = (_NormPath(root) if root else None)
+    if root and (d == root or d.startswith(root + "/")):
+      return
+
+  if version is None:
+    version = _Version(versionfile if versionfile else path)
+    if version is None:
+      return
+
+  versions = _Dirs.get(d, ())
+  if not version in versions:
+    _Dirs[d] = tuple(sorted(versions + (version,)))
+    _SortedDirs = None
+
+def _ImmutableDir(path):
+  global _SortedDirs
+
+  if _SortedDirs is None:
+    # Most specific directory first
+    _SortedDirs = sorted(_Dirs.keys(), key=lambda x: -len(x))
+
+  for d in _SortedDirs:
+    if path.startswith(d + "/"):
+      return d
+
+  return None
+
+def _Entries(d):
+  global _Cache, _Dirty
+
+  import excons
+
+  if _Cache is None:
+    _Cache = excons.ReadPersistentCache("headers")
+    atexit.register(_WriteCache)
+
+  version = "|".join(_Dirs[d])
+  cached = _Cache.get(d, None)
+  if cached is None or cached[0] != version:
+    cached = (version, {})
+    _Cache[d] = cached
+    _Dirty = True
+
+  return cached[1]
+
+def _WriteCache():
+  import excons
+  if _Dirty:
+    excons.WritePersistentCache("headers", _Cache)
+
+def Scanner():
+  import SCons.Scanner # pylint: disable=import-error
+  import SCons.Scanner.C # pylint: disable=import-error,unused-variable
+
+  class CachedCScanner(SCons.Scanner.ClassicCPP):
+    def find_include_names(self, node):
+      global _Dirty
+
+      path = _NormPath(node.get_abspath())
+      d = _ImmutableDir(path)
+      if d is None:
+        return SCons.Scanner.ClassicCPP.find_include_names(self, node)
+
+      entries = _Entries(d)
+      rel = path[len(d)+1:]
+      includes = entries.get(rel, None)
+      if includes is None:
+        includes = [tuple(x) for x in SCons.Scanner.ClassicCPP.find_include_names(self, node)]
+        entries[rel] = includes
+        _Dirty = True
+
+      return includes
+
+  # Same setup as SCons default C scanner
+  return CachedCScanner("CachedCScanner", "$CPPSUFFIXES", "CPPPATH",
+                        '^[ \t]*#[ \t]*(?:include|import)[ \t]*(<|")([^>"]+)(>|")')
+
+def Setup(env):
+  if not Enabled():
+    return None
+  import excons
+  scanner = Scanner()
+  excons.SetObjectSourceScanner(env, scanner)
+  return scanner
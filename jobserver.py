@@ -0,0 +1,122 @@
+# MIT License
+#
+# Copyright (c) 2021 Gaetan Guidet
+#
+# This file is part of excons.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+
+import os
+import re
+import sys
+import threading
+import contextlib
+
+# pylint: disable=bad-indentation,global-statement
+
+
+# GNU make compatible job server shared by SCons and nested make builds
+#   the pool holds num_jobs-1 tokens, the remaining job being implicit
+#   every job (scons command or nested make job) beyond the first one needs a token
+
+class JobServer(object):
+  def __init__(self, jobs):
+    self.jobs = jobs
+    self.rfd, self.wfd = os.pipe()
+    for fd in (self.rfd, self.wfd):
+      if hasattr(os, "set_inheritable"):
+        os.set_inheritable(fd, True)
+    os.write(self.wfd, b"+" * (jobs - 1))
+    self.lock = threading.Lock()
+    self.implicit = False
+
+  def acquire(self):
+    with self.lock:
+      if not self.implicit:
+        self.implicit = True
+        return None
+    # Blocks until a token is available
+    return os.read(self.rfd, 1)
+
+  def release(self, token):
+    if token is None:
+      with self.lock:
+        self.implicit = False
+    else:
+      os.write(self.wfd, token)
+
+  def makeflags(self, flags=None):
+    # Drop any parallel jobs or job server settings from original flags
+    flags = re.sub(r"(^|\s)(-j\d*|--jobserver-\S+)", "", flags if flags else "").strip()
+    return ("%s -j%d --jobserver-fds=%d,%d" % (flags, self.jobs, self.rfd, self.wfd)).strip()
+
+_Server = None
+_Initialized = False
+
+def Get():
+  global _Server, _Initialized
+
+  if not _Initialized:
+    import excons
+    import SCons.Script # pylint: disable=import-error
+    _Initialized = True
+    njobs = SCons.Script.GetOption("num_jobs")
+    if sys.platform != "win32" and njobs > 1 and excons.GetArgument("jobserver", 1, int) != 0:
+      _Server = JobServer(njobs)
+
+  return _Server
+
+@contextlib.contextmanager
+def Slot():
+  js = Get()
+  token = (None if js is None else js.acquire())
+  try:
+    yield
+  finally:
+    if js is not None:
+      js.release(token)
+
+def PopenArgs():
+  # python 3 subprocess closes file descriptors by default
+  js = Get()
+  if js is None or sys.version_info[0] < 3:
+    return {}
+  return {"pass_fds": (js.rfd, js.wfd)}
+
+def SetupEnv(env):
+  # Setup environment dictionary for a nested make build
+  js = Get()
+  if js is not None:
+    if env is None:
+      env = os.environ.copy()
+    env["MAKEFLAGS"] = js.makeflags(env.get("MAKEFLAGS", None))
+  return env
+
+def WrapSpawn(spawn):
+  # SCons SPAWN function running each command in a job slot
+  if Get() is None:
+    return spawn
+
+  def JobServerSpawn(sh, escape, cmd, args, env):
+    with Slot():
+      return spawn(sh, escape, cmd, args, env)
+
+  return JobServerSpawn
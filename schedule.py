@@ -0,0 +1,157 @@
+# MIT License
+#
+# Copyright (c) 2021 Gaetan Guidet
+#
+# This file is part of excons.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import os
+import atexit
+
+from . import telemetry
+
+# pylint: disable=bad-indentation,global-statement
+
+
+# Critical path scheduling, enabled by 'schedule=critical-path' flag
+#
+# Commands durations are recorded (see telemetry) and persisted in the build
+#   directory ('timings' cache, moving average of successful runs).
+# Projects are weighted by their longest compile plus their link steps and
+#   the critical path of a project is its weight plus the longest critical path
+#   of projects depending on it (as declared through deps/libs/staticlibs).
+# SCons Taskmaster is then fed candidate nodes ordered by
+#   (project critical path, node duration) so that projects gating others
+#   and long compiles start first.
+
+_Setup = False
+_Timings = None
+_Dependents = {}
+_Priorities = None
+
+
+def Enabled():
+  import excons
+  return (excons.GetArgument("schedule", "default") == "critical-path")
+
+def AddDependency(project, dep):
+  # 'project' depends on 'dep'
+  global _Priorities
+  _Dependents.setdefault(dep, set()).add(project)
+  _Priorities = None
+
+def _NodePath(node):
+  return os.path.abspath(str(node)).replace("\\", "/")
+
+def _ProjectCriticalPaths():
+  costs = {}
+  for target, duration in _Timings.iteritems():
+    info = telemetry.ProjectOf(target)
+    if info is None:
+      continue
+    cost = costs.setdefault(info[0], [0.0, 0.0])
+    ext = os.path.splitext(target)[1].lower()
+    if ext in (".o", ".os", ".obj", ".gch", ".pch"):
+      # Compiles run in parallel
+      cost[0] = max(cost[0], duration)
+    else:
+      cost[1] += duration
+
+  rv = {}
+  def CriticalPath(project, visiting):
+    if project in rv:
+      return rv[project]
+    if project in visiting:
+      return 0.0
+    visiting.add(project)
+    longest = 0.0
+    for dependent in _Dependents.get(project, ()):
+      longest = max(longest, CriticalPath(dependent, visiting))
+    visiting.discard(project)
+    cost = costs.get(project, [0.0, 0.0])
+    rv[project] = cost[0] + cost[1] + longest
+    return rv[project]
+
+  for project in set(costs.keys()).union(_Dependents.keys()):
+    CriticalPath(project, set())
+
+  return rv
+
+def Priority(node):
+  global _Priorities
+  if _Priorities is None:
+    _Priorities = _ProjectCriticalPaths()
+  path = _NodePath(node)
+  info = telemetry.ProjectOf(path)
+  return ((_Priorities.get(info[0], 0.0) if info else 0.0), _Timings.get(path, 0.0))
+
+def _UpdateTimings():
+  import excons
+  changed = False
+  for rec in telemetry.Records():
+    if rec["status"] != 0 or not rec["target"]:
+      continue
+    prev = _Timings.get(rec["target"], None)
+    _Timings[rec["target"]] = (rec["wall"] if prev is None else 0.5 * (prev + rec["wall"]))
+    changed = True
+  if changed:
+    excons.WritePersistentCache("timings", _Timings)
+
+def _PriorityTaskmaster(base):
+  class PriorityTaskmaster(base):
+    # Taskmaster pops candidates from the end of its list, highest priority last
+    def __init__(self, *args, **kwargs):
+      args = list(args)
+      if len(args) >= 3:
+        order = args[2]
+      else:
+        order = kwargs.get("order", None)
+
+      def PriorityOrder(dependencies):
+        if order is not None:
+          dependencies = order(dependencies)
+        return sorted(dependencies, key=Priority)
+
+      if len(args) >= 3:
+        args[2] = PriorityOrder
+      else:
+        kwargs["order"] = PriorityOrder
+
+      base.__init__(self, *args, **kwargs)
+
+      if hasattr(self, "top_targets_left"):
+        self.top_targets_left.sort(key=Priority)
+
+  return PriorityTaskmaster
+
+def Setup():
+  global _Setup, _Timings
+
+  if _Setup or not Enabled():
+    return
+
+  import excons
+  import SCons.Taskmaster # pylint: disable=import-error
+
+  _Setup = True
+  _Timings = excons.ReadPersistentCache("timings")
+  SCons.Taskmaster.Taskmaster = _PriorityTaskmaster(SCons.Taskmaster.Taskmaster)
+  atexit.register(_UpdateTimings)
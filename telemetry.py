@@ -0,0 +1,248 @@
+# MIT License
+#
+# Copyright (c) 2021 Gaetan Guidet
+#
+# This file is part of excons.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import os
+import sys
+import csv
+import json
+import time
+import atexit
+import threading
+
+# pylint: disable=bad-indentation,global-statement,broad-except
+
+
+# Build commands timing, enabled by 'build-report=<path>' or 'schedule=critical-path' flags
+#
+# Each command run by scons (and cmake/automake builds) is recorded with
+#   its wall time, CPU time (user + system) and peak resident memory.
+#   CPU time and memory are only available on platforms providing os.wait4.
+# Commands are attributed to projects through their target, the current target
+#   being set by excons PRINT_CMD_LINE_FUNC right before the command runs.
+#
+# At exit, writes <path> (CSV if it ends with '.csv', JSON otherwise)
+#   and <path without extension>.trace.json (chrome://tracing, perfetto)
+
+_Path = None
+_Enabled = False
+_Initialized = False
+_Lock = threading.Lock()
+_Records = []
+_Targets = {}
+_Current = threading.local()
+_Start = time.time()
+
+Fields = ["project", "type", "kind", "target", "command", "start", "wall", "cpu", "rss", "status", "thread"]
+
+
+def Enabled():
+  global _Path, _Enabled, _Initialized
+
+  if not _Initialized:
+    import excons
+    _Initialized = True
+    path = excons.GetArgument("build-report", "")
+    if path:
+      _Path = os.path.abspath(path)
+      atexit.register(WriteReport)
+    # Critical path scheduling uses recorded durations
+    _Enabled = (_Path is not None or excons.GetArgument("schedule", "default") == "critical-path")
+
+  return _Enabled
+
+def Records():
+  with _Lock:
+    return _Records[:]
+
+def ProjectOf(target):
+  # Returns (project name, project type) for target path, None if unknown
+  return _Targets.get(target, None)
+
+def AddTargets(project, ptype, nodes):
+  if not Enabled():
+    return
+  for node in nodes:
+    path = os.path.abspath(str(node)).replace("\\", "/")
+    # When a node belongs to several projects, first declared one wins
+    if not path in _Targets:
+      _Targets[path] = (project, ptype)
+
+def SetCurrentTarget(target):
+  if target:
+    t = (target[0] if isinstance(target, (list, tuple)) else target)
+    _Current.target = os.path.abspath(str(t)).replace("\\", "/")
+  else:
+    _Current.target = None
+
+def CurrentTarget():
+  return getattr(_Current, "target", None)
+
+def Wait(p):
+  # Wait for subprocess.Popen object 'p', returns (cpu seconds, peak rss in kB)
+  if not Enabled() or not hasattr(os, "wait4"):
+    p.wait()
+    return (None, None)
+  _, status, ru = os.wait4(p.pid, 0)
+  p.returncode = (os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status))
+  # ru_maxrss is in bytes on osx
+  rss = (ru.ru_maxrss // 1024 if sys.platform == "darwin" else ru.ru_maxrss)
+  return (ru.ru_utime + ru.ru_stime, rss)
+
+def _Kind(target):
+  if not target:
+    return "command"
+  ext = os.path.splitext(target)[1].lower()
+  if ext in (".o", ".os", ".obj"):
+    return "compile"
+  elif ext in (".gch", ".pch"):
+    return "pch"
+  elif ext in (".a", ".lib"):
+    return "archive"
+  else:
+    return "link"
+
+def Record(command, start, end, status, cpu=None, rss=None, kind=None, target=None):
+  if not Enabled():
+    return
+  if target is None:
+    target = CurrentTarget()
+  project, ptype = _Targets.get(target, ("", ""))
+  rec = {"project": project,
+         "type": ptype,
+         "kind": (kind if kind else _Kind(target)),
+         "target": (target if target else ""),
+         "command": command,
+         "start": start - _Start,
+         "wall": end - start,
+         "cpu": cpu,
+         "rss": rss,
+         "status": status,
+         "thread": threading.current_thread().name}
+  with _Lock:
+    _Records.append(rec)
+
+def MeasureSpawn(spawn):
+  # SCons SPAWN function collecting CPU time and memory usage
+  #   (same as SCons posix spawn, using os.wait4)
+  if not Enabled() or not hasattr(os, "wait4"):
+    return spawn
+
+  import subprocess
+  import SCons.Util # pylint: disable=import-error
+
+  def ProcessEnv(env):
+    # Same conversion as SCons _subproc: lists are joined as paths, anything else is str'ed
+    rv = {}
+    for key, value in env.iteritems():
+      if SCons.Util.is_List(value):
+        rv[key] = os.pathsep.join(map(str, SCons.Util.flatten_sequence(value)))
+      else:
+        rv[key] = str(value)
+    return rv
+
+  def UsageSpawn(sh, escape, cmd, args, env):
+    p = subprocess.Popen([sh, "-c", " ".join(args)], env=ProcessEnv(env))
+    _Current.usage = Wait(p)
+    return p.returncode
+
+  return UsageSpawn
+
+def WrapSpawn(spawn):
+  # SCons SPAWN function recording commands
+  if not Enabled():
+    return spawn
+
+  def TelemetrySpawn(sh, escape, cmd, args, env):
+    _Current.usage = (None, None)
+    start = time.time()
+    rv = spawn(sh, escape, cmd, args, env)
+    cpu, rss = _Current.usage
+    Record(os.path.basename(cmd), start, time.time(), rv, cpu=cpu, rss=rss)
+    # Current target is only set when the command line is printed
+    SetCurrentTarget(None)
+    return rv
+
+  return TelemetrySpawn
+
+def Summary(records):
+  # Totals per project and type
+  rv = {}
+  for rec in records:
+    key = "%s:%s" % (rec["project"], rec["type"])
+    s = rv.get(key, None)
+    if s is None:
+      s = {"project": rec["project"], "type": rec["type"], "commands": 0, "wall": 0.0, "cpu": 0.0, "rss": 0}
+      rv[key] = s
+    s["commands"] += 1
+    s["wall"] += rec["wall"]
+    s["cpu"] += (rec["cpu"] or 0.0)
+    s["rss"] = max(s["rss"], rec["rss"] or 0)
+  return sorted(rv.values(), key=lambda x: -x["wall"])
+
+def ChromeTrace(records):
+  # One process per project (and type), one thread per scons job
+  events = []
+  pids = {}
+  tids = {}
+  for rec in sorted(records, key=lambda x: x["start"]):
+    pkey = ("%s (%s)" % (rec["project"], rec["type"]) if rec["project"] else "<unknown>")
+    if not pkey in pids:
+      pids[pkey] = len(pids) + 1
+      events.append({"name": "process_name", "ph": "M", "pid": pids[pkey], "tid": 0, "args": {"name": pkey}})
+    tid = tids.setdefault(rec["thread"], len(tids) + 1)
+    events.append({"name": (os.path.basename(rec["target"]) if rec["target"] else rec["command"]),
+                   "cat": rec["kind"],
+                   "ph": "X",
+                   "ts": int(rec["start"] * 1000000),
+                   "dur": int(rec["wall"] * 1000000),
+                   "pid": pids[pkey],
+                   "tid": tid,
+                   "args": {"target": rec["target"], "command": rec["command"], "cpu": rec["cpu"], "rss": rec["rss"], "status": rec["status"]}})
+  return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+def WriteReport():
+  records = Records()
+
+  if _Path is None or not records:
+    return
+
+  d = os.path.dirname(_Path)
+  if d and not os.path.isdir(d):
+    os.makedirs(d)
+
+  if _Path.lower().endswith(".csv"):
+    with open(_Path, "w") as f:
+      w = csv.DictWriter(f, Fields)
+      w.writeheader()
+      for rec in records:
+        w.writerow(rec)
+  else:
+    with open(_Path, "w") as f:
+      json.dump({"commands": records, "summary": Summary(records)}, f, indent=2)
+
+  with open(os.path.splitext(_Path)[0] + ".trace.json", "w") as f:
+    json.dump(ChromeTrace(records), f)
+
+  sys.stdout.write("[excons] Build report written to '%s'\n" % _Path)
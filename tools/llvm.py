@@ -28,7 +28,7 @@ import sys
 import excons
 import subprocess
 
-# pylint: disable=bad-indentation,global-statement,deprecated-lambda,broad-except
+# pylint: disable=bad-indentation,global-statement,deprecated-lambda,broad-except,bare-except
 
 
 def _CleanList(lst):
@@ -69,121 +69,171 @@ def _IsIncludeFlag(x):
 
 # ===---
 
+# llvm-config queries, in output order when run all at once
+#   (--libs and --system-libs outputs always come last)
+LLVMConfigQueries = ["version", "cppflags", "cxxflags", "libs", "system-libs"]
+
 llvm_cfg = None
+llvm_cfgs = {}
+llvm_config_cache = None
 
-def GetLLVMConfig(components=None):
-   global llvm_cfg
+def _FindLLVMConfig():
+   exesuffix = ("" if sys.platform != "win32" else ".exe")
 
-   if llvm_cfg is None:
-      exesuffix = ("" if sys.platform != "win32" else ".exe")
+   llvm_incdir, llvm_libdir = excons.GetDirs("llvm", silent=False)
 
-      llvm_incdir, llvm_libdir = excons.GetDirs("llvm", silent=False)
+   llvm_config = None
 
-      llvm_config = None
+   if llvm_incdir:
+      path = os.path.dirname(llvm_incdir) + "/bin/llvm-config" + exesuffix
+      if os.path.isfile(path):
+         llvm_config = path
 
-      if llvm_incdir:
-         path = os.path.dirname(llvm_incdir) + "/bin/llvm-config" + exesuffix
+   if llvm_config is None:
+      if llvm_libdir:
+         path = os.path.dirname(llvm_libdir) + "/bin/llvm-config" + exesuffix
          if os.path.isfile(path):
             llvm_config = path
 
-      if llvm_config is None:
-         if llvm_libdir:
-            path = os.path.dirname(llvm_libdir) + "/bin/llvm-config" + exesuffix
-            if os.path.isfile(path):
-               llvm_config = path
+   if llvm_config is None:
+      for d in os.environ["PATH"].split(os.pathsep):
+         path = d + "/llvm-config" + exesuffix
+         if os.path.isfile(path):
+            llvm_config = path
+            break
+
+   if llvm_config is None:
+      excons.WarnOnce("Could not find 'llvm-config'", tool="llvm")
+      sys.exit(1)
+
+   excons.PrintOnce("Use '%s'" % llvm_config, tool="llvm")
+
+   return (llvm_config, llvm_incdir, llvm_libdir)
+
+def _ComponentsList(components):
+   if not components:
+      return []
+   elif type(components) in (str, unicode):
+      return components.split()
+   elif type(components) in (tuple, list, set):
+      return list(components)
+   else:
+      excons.WarnOnce("'components' should either be a string or a list of strings.", tool="llvm")
+      return []
+
+def _RunLLVMConfig(llvm_config, components):
+   # Returns query -> output dictionary (None for failed queries)
+   cmd = "%s %s" % (llvm_config, " ".join(map(lambda x: "--" + x, LLVMConfigQueries)))
+   if components:
+      cmd += " %s" % " ".join(components)
+   p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+   out, _ = p.communicate()
+   if p.returncode == 0:
+      lines = out.split("\n")
+      if len(lines) >= len(LLVMConfigQueries):
+         return dict(zip(LLVMConfigQueries, lines[:len(LLVMConfigQueries)]))
+
+   # Fallback to one query at a time (i.e. older llvm-config without --system-libs)
+   rv = {}
+   procargs = {"shell": True, "stdout": subprocess.PIPE, "stderr": subprocess.STDOUT}
+   for query in LLVMConfigQueries:
+      cmd = "%s --%s" % (llvm_config, query)
+      if query == "libs" and components:
+         cmd += " %s" % " ".join(components)
+      p = subprocess.Popen(cmd, **procargs)
+      out, _ = p.communicate()
+      if p.returncode == 0:
+         rv[query] = out
+      else:
+         excons.WarnOnce("'%s' command failed." % cmd, tool="llvm")
+         rv[query] = None
+   return rv
+
+def _QueryLLVMConfig(llvm_config, components):
+   global llvm_config_cache
+
+   # Results are persisted for a given llvm-config binary and components set
+   try:
+      mtime = os.stat(llvm_config).st_mtime
+   except:
+      mtime = None
+   key = "%s:%s:%s" % (os.path.abspath(llvm_config), mtime, " ".join(sorted(components)))
+
+   if llvm_config_cache is None:
+      llvm_config_cache = excons.ReadPersistentCache("llvm")
+
+   rv = llvm_config_cache.get(key, None)
+   if rv is None:
+      rv = _RunLLVMConfig(llvm_config, components)
+      if mtime is not None and not None in rv.values():
+         llvm_config_cache[key] = rv
+         excons.WritePersistentCache("llvm", llvm_config_cache)
+
+   return rv
+
+def _ParseLibs(out):
+   libs = []
+   for l in out.split("\n"):
+      lst = map(_LibName, (_FlagsToList(l) if sys.platform == "win32" else _CleanList(l.split("-l"))))
+      libs.extend(lst)
+   return libs
 
-      if llvm_config is None:
-         for d in os.environ["PATH"].split(os.pathsep):
-            path = d + "/llvm-config" + exesuffix
-            if os.path.isfile(path):
-               llvm_config = path
-               break
+def GetLLVMConfig(components=None):
+   global llvm_cfg, llvm_cfgs
 
-      if llvm_config is None:
-         excons.WarnOnce("Could not find 'llvm-config'", tool="llvm")
-         sys.exit(1)
+   components = _ComponentsList(components)
+   key = " ".join(sorted(components))
 
-      excons.PrintOnce("Use '%s'" % llvm_config, tool="llvm")
+   if not key in llvm_cfgs:
+      llvm_config, llvm_incdir, llvm_libdir = _FindLLVMConfig()
 
-      llvm_cfg = {}
-      procargs = {"shell": True, "stdout": subprocess.PIPE, "stderr": subprocess.STDOUT}
+      cfg = {}
 
       if llvm_incdir:
-         llvm_cfg["incdir"] = llvm_incdir
+         cfg["incdir"] = llvm_incdir
 
       if llvm_libdir:
-         llvm_cfg["libdir"] = llvm_libdir
+         cfg["libdir"] = llvm_libdir
 
-      cmd = "%s --version" % llvm_config
-      p = subprocess.Popen(cmd, **procargs)
-      out, _ = p.communicate()
-      if p.returncode == 0:
-         llvm_cfg["version_str"] = out.strip()
-         spl = llvm_cfg["version_str"].split(".")
-         llvm_cfg["version_major"] = int(spl[0])
-         llvm_cfg["version_minor"] = int(spl[1])
+      outputs = _QueryLLVMConfig(llvm_config, components)
+
+      out = outputs["version"]
+      if out is not None:
+         cfg["version_str"] = out.strip()
+         spl = cfg["version_str"].split(".")
+         cfg["version_major"] = int(spl[0])
+         cfg["version_minor"] = int(spl[1])
       else:
-         excons.WarnOnce("'%s' command failed." % cmd, tool="llvm")
-         llvm_cfg["verison_str"] = ""
-         llvm_cfg["verison_major"] = 0
-         llvm_cfg["verison_minor"] = 0
+         cfg["version_str"] = ""
+         cfg["version_major"] = 0
+         cfg["version_minor"] = 0
 
-      cmd = "%s --cppflags" % llvm_config
-      p = subprocess.Popen(cmd, **procargs)
-      out, _ = p.communicate()
-      if p.returncode == 0:
+      out = outputs["cppflags"]
+      if out is not None:
          cppflags = out.strip()
-         llvm_cfg["cppflags"] = " " + " ".join(filter(lambda x: not _IsIncludeFlag(x), _FlagsToList(cppflags)))
+         cfg["cppflags"] = " " + " ".join(filter(lambda x: not _IsIncludeFlag(x), _FlagsToList(cppflags)))
       else:
-         excons.WarnOnce("'%s' command failed." % cmd, tool="llvm")
-         llvm_cfg["cppflags"] = ""
+         cfg["cppflags"] = ""
 
-      cmd = "%s --cxxflags" % llvm_config
-      p = subprocess.Popen(cmd, **procargs)
-      out, _ = p.communicate()
-      if p.returncode == 0:
+      out = outputs["cxxflags"]
+      if out is not None:
          cxxflags = _FlagsToList(out.strip())
          if sys.platform != "win32":
-            llvm_cfg["rtti"] = (not "-fno-rtti" in cxxflags)
-            llvm_cfg["exceptions"] = (not "-fno-exceptions" in cxxflags)
+            cfg["rtti"] = (not "-fno-rtti" in cxxflags)
+            cfg["exceptions"] = (not "-fno-exceptions" in cxxflags)
          else:
-            llvm_cfg["rtti"] = (not "/GR-" in cxxflags)
-            llvm_cfg["exceptions"] = (not "/EHs-c-" in cxxflags)
-      else:
-         excons.WarnOnce("'%s' command failed." % cmd, tool="llvm")
+            cfg["rtti"] = (not "/GR-" in cxxflags)
+            cfg["exceptions"] = (not "/EHs-c-" in cxxflags)
 
-      cmd = "%s --libs" % llvm_config
-      if components:
-         if type(components) in (str, unicode):
-            cmd += " %s" % components
-         elif type(components) in (tuple, list, set):
-            cmd += " %s" % " ".join(components)
-         else:
-            excons.WarnOnce("'components' should either be a string or a list of strings.", tool="llvm")
-      p = subprocess.Popen(cmd, **procargs)
-      out, _ = p.communicate()
-      if p.returncode == 0:      
-         libs = []
-         for l in out.split("\n"):
-            lst = map(_LibName, (_FlagsToList(l) if sys.platform == "win32" else _CleanList(l.split("-l"))))
-            libs.extend(lst)
-         llvm_cfg["libs"] = libs
-      else:
-         excons.WarnOnce("'%s' command failed." % cmd, tool="llvm")
-         llvm_cfg["libs"] = []
+      out = outputs["libs"]
+      cfg["libs"] = ([] if out is None else _ParseLibs(out))
 
-      cmd = "%s --system-libs" % llvm_config
-      p = subprocess.Popen(cmd, **procargs)
-      out, _ = p.communicate()
-      if p.returncode == 0:
-         libs = []
-         for l in out.split("\n"):
-            lst = map(_LibName, (_FlagsToList(l) if sys.platform == "win32" else _CleanList(l.split("-l"))))
-            libs.extend(lst)
-         llvm_cfg["syslibs"] = libs
-      else:
-         excons.WarnOnce("'%s' command failed." % cmd, tool="llvm")
-         llvm_cfg["syslibs"] = []
+      out = outputs["system-libs"]
+      cfg["syslibs"] = ([] if out is None else _ParseLibs(out))
+
+      llvm_cfgs[key] = cfg
+
+   llvm_cfg = llvm_cfgs[key]
 
    return llvm_cfg
 
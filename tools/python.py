@@ -27,12 +27,11 @@ import SCons.Script # pylint: disable=import-error
 import os
 import re
 import sys
-import subprocess
 import excons
 import distutils
 import distutils.sysconfig
 
-# pylint: disable=bad-indentation,global-statement,unused-argument,deprecated-lambda
+# pylint: disable=bad-indentation,global-statement,unused-argument,deprecated-lambda,bare-except
 
 
 def GetOptionsString():
@@ -42,9 +41,11 @@ def GetOptionsString():
 def _GetPythonVersionOSX(pythonPath):
   # On osx, pythonPath must be the path to the python framework
   # i.e.  with-python=/System/Library/Frameworks/Python.framework
-  p = subprocess.Popen("ls -l %s/Versions | grep Current" % pythonPath, shell=True, stdout=subprocess.PIPE)
-  out, _ = p.communicate()
-  m = re.search(r"Current\s+->\s+(%s/Versions/)?([0-9\.]+)" % pythonPath, out)
+  try:
+    link = os.readlink("%s/Versions/Current" % pythonPath)
+  except:
+    return None
+  m = re.match(r"^(%s/Versions/)?([0-9\.]+)/?$" % re.escape(pythonPath), link)
   if m is not None:
     return m.group(2)
   return None
@@ -60,24 +61,138 @@ def _GetPythonVersionWIN(pythonPath):
       return "%s.%s" % (m.group(1), m.group(2))
   return None
 
+def _GetELFNeeded(path):
+  # Returns the list of DT_NEEDED entries of an ELF binary, None if path is not an ELF binary
+  import struct
+  
+  with open(path, "rb") as f:
+    ident = f.read(16)
+    if len(ident) < 16 or ident[:4] != "\x7fELF":
+      return None
+    
+    is64 = (ord(ident[4]) == 2)
+    endian = ("<" if ord(ident[5]) == 1 else ">")
+    
+    # Program headers location
+    if is64:
+      f.seek(32)
+      phoff = struct.unpack(endian + "Q", f.read(8))[0]
+      f.seek(54)
+      phentsize, phnum = struct.unpack(endian + "HH", f.read(4))
+      phfmt = endian + "IIQQQQQQ"
+    else:
+      f.seek(28)
+      phoff = struct.unpack(endian + "I", f.read(4))[0]
+      f.seek(42)
+      phentsize, phnum = struct.unpack(endian + "HH", f.read(4))
+      phfmt = endian + "IIIIIIII"
+    
+    loads = []
+    dynamic = None
+    for i in xrange(phnum):
+      f.seek(phoff + i * phentsize)
+      ph = struct.unpack(phfmt, f.read(struct.calcsize(phfmt)))
+      if is64:
+        ptype, _, poffset, pvaddr, _, pfilesz, _, _ = ph
+      else:
+        ptype, poffset, pvaddr, _, pfilesz, _, _, _ = ph
+      if ptype == 1: # PT_LOAD
+        loads.append((pvaddr, poffset, pfilesz))
+      elif ptype == 2: # PT_DYNAMIC
+        dynamic = (poffset, pfilesz)
+    
+    if dynamic is None:
+      # Static binary
+      return []
+    
+    dynfmt = endian + ("qQ" if is64 else "iI")
+    dynsize = struct.calcsize(dynfmt)
+    f.seek(dynamic[0])
+    data = f.read(dynamic[1])
+    needed = []
+    strtab = None
+    for i in xrange(len(data) / dynsize):
+      tag, val = struct.unpack(dynfmt, data[i*dynsize:(i+1)*dynsize])
+      if tag == 0: # DT_NULL
+        break
+      elif tag == 1: # DT_NEEDED
+        needed.append(val)
+      elif tag == 5: # DT_STRTAB
+        strtab = val
+    
+    if strtab is None:
+      return []
+    
+    # DT_STRTAB is a virtual address
+    stroff = None
+    for vaddr, offset, size in loads:
+      if strtab >= vaddr and strtab < vaddr + size:
+        stroff = strtab - vaddr + offset
+        break
+    if stroff is None:
+      return []
+    
+    rv = []
+    for off in needed:
+      f.seek(stroff + off)
+      name = ""
+      while True:
+        chunk = f.read(64)
+        if not chunk:
+          break
+        idx = chunk.find("\0")
+        if idx >= 0:
+          name += chunk[:idx]
+          break
+        name += chunk
+      rv.append(name)
+    
+    return rv
+
 def _GetPythonVersionUNIX(pythonPath):
   # On unix, pythonPath must be the path to the python executable
   # i.e.  with-python=/usr/local/bin/python
-  p = subprocess.Popen("ldd %s | grep libpython" % pythonPath, shell=True, stdout=subprocess.PIPE)
-  out, _ = p.communicate()
-  m = re.search(r"libpython([0-9\.]+)\.so", out)
-  if m is not None:
-    return m.group(1)
+  try:
+    needed = _GetELFNeeded(pythonPath)
+  except Exception as e:
+    excons.WarnOnce("Failed to read '%s' dependencies (%s)" % (pythonPath, e), tool="python")
+    needed = None
+  for name in (needed if needed else []):
+    m = re.search(r"libpython([0-9\.]+)\.so", name)
+    if m is not None:
+      return m.group(1)
   return None
 
 _specCache = {}
+_persistentSpecCache = None
+
+def _PersistentSpecKey(specString):
+  # Only interpreter/framework path specifications are persisted
+  #   key on path modification time and target architecture
+  try:
+    mtime = os.stat(specString).st_mtime
+  except:
+    return None
+  return "%s:%s:%s:%s" % (specString, mtime, sys.platform, ("x64" if excons.Build64() else "x86"))
 
 def _GetPythonSpec(specString):
-  global _specCache
+  global _specCache, _persistentSpecCache
 
   if specString in _specCache:
     return _specCache[specString]
 
+  pkey = None
+  if not re.match(r"\d+\.\d+", specString):
+    pkey = _PersistentSpecKey(specString)
+    if pkey is not None:
+      if _persistentSpecCache is None:
+        _persistentSpecCache = excons.ReadPersistentCache("python")
+      spec = _persistentSpecCache.get(pkey, None)
+      if spec is not None:
+        excons.PrintOnce("Resolved python for \"%s\": %s" % (specString, spec), tool="python")
+        _specCache[specString] = spec
+        return spec
+
   spec = None
   specErr = ""
 
@@ -247,6 +362,10 @@ def _GetPythonSpec(specString):
   
   _specCache[specString] = spec
 
+  if pkey is not None and spec is not None:
+    _persistentSpecCache[pkey] = spec
+    excons.WritePersistentCache("python", _persistentSpecCache)
+
   return spec
 
 def Version():